@@ -0,0 +1,48 @@
+"""
+Startup cost of `import qc` and of the first access to each virtual module.
+
+Every measurement runs in a fresh interpreter so nothing is cached between
+runs; needs the same database access as the package itself.
+
+    python benchmarks/bench_import.py --repeat 5
+"""
+import argparse
+import json
+import subprocess
+import sys
+import pandas as pd
+
+PROBE = """
+import json, time
+start = time.perf_counter()
+import qc
+from qc import V
+rec = {"import qc": time.perf_counter() - start}
+for name in %r:
+    start = time.perf_counter()
+    getattr(V, name)
+    rec[f"V.{name}"] = time.perf_counter() - start
+print(json.dumps(rec))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--modules", nargs="+", default=["treadmill", "pupil", "stack"])
+    args = parser.parse_args()
+
+    rec = []
+    for _ in range(args.repeat):
+        out = subprocess.run(
+            [sys.executable, "-c", PROBE % (args.modules,)],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        rec.append(json.loads(out.strip().splitlines()[-1]))
+    print(pd.DataFrame.from_records(rec).describe().loc[["mean", "std", "min", "max"]])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Scaling of the key matching in `jobs.get_jobs` with the size of the jobs table.
+
+Compares the per-row `compatible_keys` scan against the vectorized
+`match_keys` join on synthetic job keys, and checks that both match the
+same jobs.
+
+    python benchmarks/bench_jobs.py --sizes 1000 10000 50000 --targets 400
+"""
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from qc.jobs import compatible_keys, match_keys
+
+
+def synthetic_keys(n, rng):
+    keys = []
+    for animal_id, session, scan_idx, kind in zip(
+        rng.integers(1, 200, n),
+        rng.integers(1, 10, n),
+        rng.integers(1, 30, n),
+        rng.integers(0, 3, n),
+    ):
+        key = dict(animal_id=int(animal_id), session=int(session))
+        if kind == 0:
+            key.update(scan_idx=int(scan_idx), pipe_version=1)
+        elif kind == 1:
+            key.update(scan_idx=int(scan_idx), pipe_version=1, field=1, channel=1)
+        else:
+            key.update(stack_idx=int(scan_idx), volume_id=1)
+        keys.append(key)
+    return keys
+
+
+def apply_match(keys, target_keys):
+    keys = pd.Series(keys)
+    target = np.zeros(len(keys), dtype=bool)
+    for target_key in target_keys:
+        target = target | keys.apply(lambda key: compatible_keys(key, target_key))
+    return target
+
+
+def vectorized_match(keys, target_keys):
+    target = np.zeros(len(keys), dtype=bool)
+    target[match_keys(keys, target_keys)["index"].to_numpy()] = True
+    return target
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--targets", type=int, default=400)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    target_keys = [
+        dict(animal_id=k["animal_id"], session=k["session"], scan_idx=k["scan_idx"])
+        for k in synthetic_keys(args.targets * 3, rng)
+        if "scan_idx" in k
+    ][: args.targets]
+    rec = []
+    for n in args.sizes:
+        keys = synthetic_keys(n, rng)
+        masks = {}
+        for name, match in [("apply", apply_match), ("vectorized", vectorized_match)]:
+            start = time.perf_counter()
+            target = masks[name] = np.asarray(match(keys, target_keys))
+            rec.append(
+                dict(
+                    jobs=n,
+                    targets=len(target_keys),
+                    method=name,
+                    matched=int(target.sum()),
+                    seconds=time.perf_counter() - start,
+                )
+            )
+            print(rec[-1])
+        assert (masks["apply"] == masks["vectorized"]).all(), (
+            f"match_keys and compatible_keys match different jobs out of {n}"
+        )
+    print(pd.DataFrame.from_records(rec).pivot(index="jobs", columns="method", values="seconds"))
+
+
+if __name__ == "__main__":
+    main()
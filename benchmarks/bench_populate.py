@@ -0,0 +1,118 @@
+"""
+Throughput of `qc.schemas.populate` workers against the stand-in schemas of
+`standin.py` on a local MySQL.
+
+PipelineQcJob is filled with stand-in scans whose recordings are short, so
+that every step fetches, renders and saves in a fraction of a second; the
+registration over time of a fraction of them is removed, so that their rot
+step fails, to check that failures stay per step. The same jobs are drained
+by an increasing number of worker processes, each running the real
+PipelineQcStepDone.populate with reserved jobs.
+
+    docker compose -f benchmarks/docker-compose.yml up -d
+    DJ_HOST=127.0.0.1 DJ_USER=root DJ_PASS=simple \\
+        python benchmarks/bench_populate.py --generate --jobs 200 --workers 1 2 4 8
+
+`--generate` (re)creates the stand-in data first; later runs reuse it.
+"""
+import argparse
+import multiprocessing as mp
+import os
+import tempfile
+import time
+import datajoint as dj
+import pandas as pd
+import standin
+from qc import V
+
+PREFIX = "qc_bench_populate_"
+METHODS = dict(pipe_version=1, segmentation_method=6, spike_method=6, registration_method=5)
+
+
+def worker():
+    standin.use(PREFIX)
+    from qc import schemas
+
+    schemas.populate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--root", default=tempfile.gettempdir() + "/qc_bench_populate")
+    parser.add_argument("--generate", action="store_true")
+    parser.add_argument("--jobs", type=int, default=200)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--fail-rate", type=float, default=0.05)
+    parser.add_argument("--pupil-frames", type=int, default=2000)
+    parser.add_argument("--treadmill-samples", type=int, default=20_000)
+    parser.add_argument("--rot-frames", type=int, default=2000)
+    args = parser.parse_args()
+    # read by qc.schemas in this process and in the workers
+    os.environ["PIPELINE_QC_SCHEMA"] = PREFIX + "qc"
+    os.environ["PIPELINE_QC_ROOT"] = args.root + "/figures"
+
+    if args.generate:
+        # the QC tables reference the stand-in ones
+        if PREFIX + "qc" in dj.list_schemas():
+            dj.Schema(PREFIX + "qc", create_schema=False).drop(force=True)
+        standin.drop(PREFIX)
+        standin.declare(PREFIX)
+        _, keys = standin.generate(
+            args.root,
+            n_scans=args.jobs,
+            n_heavy=args.jobs,
+            n_jobs=0,
+            pupil_frames=args.pupil_frames,
+            treadmill_samples=args.treadmill_samples,
+            rot_frames=args.rot_frames,
+        )
+        failing = keys[: int(args.fail_rate * len(keys))]
+        if failing:
+            (
+                V.stack.RegistrationOverTime
+                & [
+                    dict(animal_id=k["animal_id"], scan_session=k["session"], scan_idx=k["scan_idx"])
+                    for k in failing
+                ]
+            ).delete(safemode=False)
+    else:
+        standin.use(PREFIX)
+        keys = V.treadmill.Treadmill.fetch("KEY")
+    from qc import schemas
+
+    schemas.PipelineQcJob.insert((dict(k, **METHODS) for k in keys), skip_duplicates=True)
+    n_steps = len(schemas.PipelineQcStepDone.key_source)
+    rec = []
+    for n in args.workers:
+        schemas.PipelineQcStepDone.delete_quick()
+        schemas.schema.jobs.delete_quick()
+        ctx = mp.get_context("spawn")
+        procs = [ctx.Process(target=worker) for _ in range(n)]
+        start = time.perf_counter()
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        seconds = time.perf_counter() - start
+        failed = (schemas.schema.jobs & 'status="error"').fetch("key")
+        rec.append(
+            dict(
+                workers=n,
+                seconds=seconds,
+                steps_per_sec=n_steps / seconds,
+                done=len(schemas.PipelineQcStepDone),
+                errors=len(failed),
+                # the other steps of a job whose rot failed are still done
+                siblings_done=len(
+                    schemas.PipelineQcStepDone
+                    & [{k: v for k, v in f.items() if k != "qc_step"} for f in failed]
+                ),
+            )
+        )
+    results = pd.DataFrame.from_records(rec).set_index("workers")
+    results["speedup"] = results["steps_per_sec"] / results["steps_per_sec"].iloc[0]
+    print(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Throughput, DB queries and memory of the main code paths, against the
+stand-in schemas of `standin.py` on a local MySQL.
+
+    docker compose -f benchmarks/docker-compose.yml up -d
+    export DJ_HOST=127.0.0.1 DJ_USER=root DJ_PASS=simple
+    python benchmarks/bench_suite.py --generate --n-scans 1000 --n-jobs 50000
+    python benchmarks/bench_suite.py --save base.json
+    python benchmarks/bench_suite.py --compare base.json
+
+`--generate` (re)creates the stand-in data first; later runs reuse it.
+With `--compare`, benchmarks slower than the baseline by more than
+`--tolerance`, or issuing more queries, are flagged and the exit status is 1.
+"""
+import argparse
+import json
+import sys
+import tempfile
+import time
+import matplotlib
+
+matplotlib.use("Agg")
+from matplotlib import pyplot as plt
+import pandas as pd
+import standin
+from qc import Batch, Scan, V, instrument, jobs
+from qc.status import BatchStatus, scan_id
+
+
+def measure(name, func, n_items):
+    queries, nbytes = instrument.session_status()
+    instrument.reset_peak_rss()
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+    end_queries, end_bytes = instrument.session_status()
+    plt.close("all")
+    return dict(
+        benchmark=name,
+        items=n_items,
+        seconds=seconds,
+        items_per_sec=n_items / seconds,
+        queries=end_queries - queries - 1,
+        bytes=end_bytes - nbytes,
+        peak_rss=instrument.peak_rss(),
+    )
+
+
+def run(keys, heavy, root):
+    batch = Batch(keys)
+    _, errors = BatchStatus(keys).stack_reg_task
+    valid = [k for k in keys if scan_id(k) not in errors]
+    valid_batch = Batch(valid)
+    heavy_scans = [Scan(**k) for k in heavy]
+    benchmarks = [
+        ("Batch.scan_done", lambda: batch.scan_done, len(keys)),
+        ("BatchStatus.stack_reg_task", lambda: BatchStatus(keys).stack_reg_task, len(keys)),
+        ("Batch.stack_reg_done", lambda: valid_batch.stack_reg_done, len(valid)),
+        ("Batch.stack_rot_done", lambda: valid_batch.stack_rot_done, len(valid)),
+        ("Batch.jobs_df", lambda: batch.jobs_df, len(keys)),
+        ("Batch.progress", lambda: batch.progress, len(keys)),
+        ("jobs.get_jobs", lambda: jobs.get_jobs(jobs.jobs_schemas, keys), len(keys)),
+        (
+            "Batch.delete_errors (dry run)",
+            lambda: batch.delete_errors(bulk=True, dry_run=True),
+            len(keys),
+        ),
+        ("Scan.treadmill_qc", lambda: [s.treadmill_qc() for s in heavy_scans], len(heavy)),
+        ("Scan.pupil_qc", lambda: [s.pupil_qc() for s in heavy_scans], len(heavy)),
+        ("Scan.rot_qc", lambda: [s.rot_qc() for s in heavy_scans], len(heavy)),
+        (
+            "Batch.run_qc",
+            lambda: Batch(heavy).run_qc(filepath=root, force=True),
+            len(heavy),
+        ),
+        (
+            "Batch.run_qc (metrics only)",
+            lambda: Batch(heavy).run_qc(filepath=root, render=False),
+            len(heavy),
+        ),
+    ]
+    return pd.DataFrame.from_records(
+        [measure(*b) for b in benchmarks]
+    ).set_index("benchmark")
+
+
+def compare(results, baseline, tolerance):
+    ratio = pd.DataFrame(
+        dict(
+            seconds=results["seconds"] / baseline["seconds"],
+            queries=results["queries"] - baseline["queries"],
+        )
+    )
+    ratio["regressed"] = (ratio["seconds"] > 1 + tolerance) | (ratio["queries"] > 0)
+    return ratio
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--root", default=tempfile.gettempdir() + "/qc_standin")
+    parser.add_argument("--generate", action="store_true")
+    parser.add_argument("--n-scans", type=int, default=1000)
+    parser.add_argument("--n-heavy", type=int, default=3)
+    parser.add_argument("--n-jobs", type=int, default=50_000)
+    parser.add_argument("--pupil-frames", type=int, default=100_000)
+    parser.add_argument("--save")
+    parser.add_argument("--compare")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.generate:
+        standin.drop()
+    standin.declare()
+    if args.generate:
+        keys, heavy = standin.generate(
+            args.root,
+            n_scans=args.n_scans,
+            n_heavy=args.n_heavy,
+            n_jobs=args.n_jobs,
+            pupil_frames=args.pupil_frames,
+        )
+    else:
+        keys = V.experiment.Scan.fetch("KEY", order_by="animal_id, session, scan_idx")
+        heavy = V.treadmill.Treadmill.fetch("KEY")
+
+    results = run(keys, heavy, args.root + "/figures")
+    print(results.to_string())
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results.reset_index().to_dict("records"), f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = pd.DataFrame.from_records(json.load(f)).set_index("benchmark")
+        ratio = compare(results, baseline, args.tolerance)
+        print(ratio.to_string())
+        sys.exit(int(ratio["regressed"].any()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,613 @@
+"""
+Stand-in for the lab pipeline schemas, for benchmarking against a local MySQL
+(see docker-compose.yml) instead of the lab database.
+
+`declare` creates every schema in `qc.virtual.schemas` under a prefix, with
+the tables and attributes the package queries, and points `qc.virtual` at
+them; `generate` fills them with synthetic data of realistic sizes, writing
+the behavior videos of the pupil QC to a local folder:
+
+    import standin
+    standin.declare()
+    standin.generate("/tmp/qc_standin", n_scans=1000, n_jobs=50_000)
+"""
+import platform
+import types
+from pathlib import Path
+import cv2
+import datajoint as dj
+import numpy as np
+from datajoint.hash import key_hash
+from qc import virtual as V, utils
+
+PREFIX = "qc_standin_"
+CHUNK = 5000
+
+
+def _shared_tables():
+    class PipelineVersion(dj.Lookup):
+        definition = """
+        pipe_version: smallint
+        """
+        contents = [(1,)]
+
+    class SegmentationMethod(dj.Lookup):
+        definition = """
+        segmentation_method: tinyint
+        """
+        contents = [(6,)]
+
+    class SpikeMethod(dj.Lookup):
+        definition = """
+        spike_method: tinyint
+        """
+        contents = [(6,)]
+
+    class RegistrationMethod(dj.Lookup):
+        definition = """
+        registration_method: tinyint
+        """
+        contents = [(5,)]
+
+    return [PipelineVersion, SegmentationMethod, SpikeMethod, RegistrationMethod]
+
+
+def _lab_tables():
+    class Paths(dj.Manual):
+        definition = """
+        global: varchar(255)
+        ---
+        linux: varchar(255)
+        windows: varchar(255)
+        """
+
+    return [Paths]
+
+
+def _experiment_tables():
+    class Session(dj.Manual):
+        definition = """
+        animal_id: int
+        session: smallint
+        ---
+        scan_path: varchar(255)
+        """
+
+    class Scan(dj.Manual):
+        definition = """
+        -> Session
+        scan_idx: smallint
+        """
+
+    class Stack(dj.Manual):
+        definition = """
+        -> Session
+        stack_idx: smallint
+        """
+
+    class AutoProcessing(dj.Manual):
+        definition = """
+        -> Scan
+        ---
+        priority: tinyint
+        autosegment: bool
+        """
+
+    return [Session, Scan, Stack, AutoProcessing]
+
+
+def _collection_tables():
+    class CuratedScan(dj.Manual):
+        definition = """
+        -> experiment.Scan
+        ---
+        study_name: varchar(64)
+        scan_purpose: varchar(64)
+        notes="": varchar(255)
+        score: tinyint
+        score_ts=CURRENT_TIMESTAMP: timestamp
+        """
+
+    return [CuratedScan]
+
+
+def _fuse_tables():
+    class ScanSet(dj.Manual):
+        definition = """
+        -> experiment.Scan
+        -> shared.PipelineVersion
+        -> shared.SegmentationMethod
+        ---
+        pipe: varchar(8)
+        """
+
+    return [ScanSet]
+
+
+def _pipe_tables():
+    # shared by meso and reso
+    class ScanInfo(dj.Manual):
+        definition = """
+        -> experiment.Scan
+        -> shared.PipelineVersion
+        ---
+        nfields: tinyint
+        """
+
+        class Field(dj.Part):
+            definition = """
+            -> master
+            field: tinyint
+            """
+
+    class CorrectionChannel(dj.Manual):
+        definition = """
+        -> ScanInfo.Field
+        ---
+        channel: tinyint
+        """
+
+    class Quality(dj.Manual):
+        definition = """
+        -> ScanInfo
+        """
+
+    class RasterCorrection(dj.Manual):
+        definition = """
+        -> CorrectionChannel
+        """
+
+    class MotionCorrection(dj.Manual):
+        definition = """
+        -> RasterCorrection
+        """
+
+    class SummaryImages(dj.Manual):
+        definition = """
+        -> MotionCorrection
+        """
+
+    class Segmentation(dj.Manual):
+        definition = """
+        -> MotionCorrection
+        -> shared.SegmentationMethod
+        """
+
+    class Fluorescence(dj.Manual):
+        definition = """
+        -> Segmentation
+        """
+
+    class MaskClassification(dj.Manual):
+        definition = """
+        -> Segmentation
+        """
+
+    class ScanSet(dj.Manual):
+        definition = """
+        -> Fluorescence
+        """
+
+    class Activity(dj.Manual):
+        definition = """
+        -> ScanSet
+        -> shared.SpikeMethod
+        """
+
+    class ScanDone(dj.Manual):
+        definition = """
+        -> ScanInfo
+        -> shared.SegmentationMethod
+        -> shared.SpikeMethod
+        """
+
+    return [
+        ScanInfo,
+        CorrectionChannel,
+        Quality,
+        RasterCorrection,
+        MotionCorrection,
+        SummaryImages,
+        Segmentation,
+        Fluorescence,
+        MaskClassification,
+        ScanSet,
+        Activity,
+        ScanDone,
+    ]
+
+
+REG_KEY = """
+    animal_id: int
+    stack_session: smallint
+    stack_idx: smallint
+    volume_id: tinyint
+    stack_channel: tinyint
+    scan_session: smallint
+    scan_idx: smallint
+    scan_channel: tinyint
+    field: tinyint
+    -> shared.RegistrationMethod
+"""
+
+
+def _stack_tables():
+    class CorrectionChannel(dj.Manual):
+        definition = """
+        -> experiment.Stack
+        ---
+        channel: tinyint
+        """
+
+    class CorrectedStack(dj.Manual):
+        definition = """
+        -> experiment.Stack
+        volume_id: tinyint
+        """
+
+    class PreprocessedStack(dj.Manual):
+        definition = """
+        -> CorrectedStack
+        """
+
+    class RegistrationTask(dj.Manual):
+        definition = REG_KEY
+
+    class Registration(dj.Manual):
+        definition = """
+        -> RegistrationTask
+        """
+
+    class RegistrationOverTimeTask(dj.Manual):
+        definition = REG_KEY
+
+    class RegistrationOverTime(dj.Manual):
+        definition = """
+        -> RegistrationOverTimeTask
+        """
+
+        class Affine(dj.Part):
+            definition = """
+            -> master
+            frame_num: int
+            ---
+            reg_z: float
+            """
+
+    return [
+        CorrectionChannel,
+        CorrectedStack,
+        PreprocessedStack,
+        RegistrationTask,
+        Registration,
+        RegistrationOverTimeTask,
+        RegistrationOverTime,
+    ]
+
+
+def _treadmill_tables():
+    class Treadmill(dj.Manual):
+        definition = """
+        -> experiment.Scan
+        ---
+        treadmill_raw: longblob
+        treadmill_time: longblob
+        treadmill_vel: longblob
+        """
+
+    return [Treadmill]
+
+
+def _pupil_tables():
+    class Tracking(dj.Manual):
+        definition = """
+        -> experiment.Scan
+        tracking_method: tinyint
+        """
+
+        class Deeplabcut(dj.Part):
+            definition = """
+            -> master
+            ---
+            cropped_x0: smallint
+            cropped_x1: smallint
+            cropped_y0: smallint
+            cropped_y1: smallint
+            """
+
+    class FittedPupil(dj.Manual):
+        definition = """
+        -> Tracking
+        fitting_method: tinyint
+        """
+
+        class Circle(dj.Part):
+            definition = """
+            -> master
+            frame_id: int
+            ---
+            center=null: tinyblob
+            radius=null: float
+            """
+
+        class EyePoints(dj.Part):
+            definition = """
+            -> master
+            label: varchar(32)
+            ---
+            x: longblob
+            y: longblob
+            """
+
+    return [Tracking, FittedPupil]
+
+
+# in declaration order, so that every schema follows those it refers to
+TABLES = dict(
+    shared=_shared_tables,
+    lab=_lab_tables,
+    experiment=_experiment_tables,
+    collection=_collection_tables,
+    fuse=_fuse_tables,
+    meso=_pipe_tables,
+    reso=_pipe_tables,
+    stack=_stack_tables,
+    treadmill=_treadmill_tables,
+    pupil=_pupil_tables,
+    stimulus=lambda: [],
+)
+
+
+def declare(prefix=PREFIX):
+    """
+    Declare the stand-in schemas (`prefix` + the name of each virtual module)
+    and point `qc.virtual` at them. Returns the stand-in modules by name.
+    """
+    modules = {}
+    for name, tables in TABLES.items():
+        schema = dj.Schema(prefix + name, create_schema=True)
+        local = {}
+        for cls in tables():
+            local[cls.__name__] = cls
+            schema(cls, context={**modules, **local})
+        modules[name] = types.SimpleNamespace(schema=schema, **local)
+    use(prefix)
+    return modules
+
+
+def use(prefix=PREFIX):
+    """Point `qc.virtual` at the stand-in schemas of `prefix`, declared before."""
+    for name in TABLES:
+        V.schemas[name] = prefix + name
+        vars(V).pop(name, None)
+    utils.refresh_path_map()
+
+
+def drop(prefix=PREFIX):
+    """Drop every stand-in schema."""
+    existing = dj.list_schemas()
+    for name in reversed(list(TABLES)):
+        if prefix + name in existing:
+            dj.Schema(prefix + name, create_schema=False).drop(force=True)
+
+
+def _insert(table, rows):
+    rows = list(rows)
+    for i in range(0, len(rows), CHUNK):
+        table.insert(rows[i : i + CHUNK], skip_duplicates=True)
+
+
+def write_video(path, n_frames, width=64, height=48, seed=0):
+    """A synthetic eye video: a dark disc moving over noise."""
+    rng = np.random.default_rng(seed)
+    writer = cv2.VideoWriter(
+        str(path), cv2.VideoWriter_fourcc(*"MJPG"), 30, (width, height)
+    )
+    yy, xx = np.mgrid[:height, :width]
+    noise = rng.integers(100, 160, (height, width), dtype=np.uint8)
+    for t in range(n_frames):
+        cx = width / 2 + width / 6 * np.sin(t / 50)
+        frame = np.where((xx - cx) ** 2 + (yy - height / 2) ** 2 < 64, 30, noise)
+        writer.write(cv2.cvtColor(frame.astype(np.uint8), cv2.COLOR_GRAY2BGR))
+    writer.release()
+
+
+def generate(
+    root,
+    n_scans=1000,
+    n_fields=4,
+    n_heavy=3,
+    pupil_frames=100_000,
+    treadmill_samples=360_000,
+    rot_frames=20_000,
+    n_jobs=50_000,
+    seed=0,
+):
+    """
+    Fill the declared stand-in schemas. Every scan gets the metadata the
+    status queries and task scheduling read, in varying states of completion
+    (meso scans with `n_fields` fields, reso scans with one); the first
+    `n_heavy` scans also get treadmill, pupil and registration over time
+    data of the given sizes, with behavior videos written under `root`.
+    `n_jobs` error and reserved rows are spread over the jobs tables.
+    Returns the keys of all scans and of the heavy ones.
+    """
+    assert "linux" in platform.system().lower()
+    rng = np.random.default_rng(seed)
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    m = {name: getattr(V, name) for name in TABLES if name != "stimulus"}
+
+    m["lab"].Paths.insert1(
+        dict(**{"global": "/standin"}, linux=str(root), windows="S:\\"),
+        skip_duplicates=True,
+    )
+    keys = [
+        dict(animal_id=1000 + i // 50, session=1 + i // 5 % 10, scan_idx=1 + i % 5)
+        for i in range(n_scans)
+    ]
+    sessions = {(k["animal_id"], k["session"]) for k in keys}
+    _insert(
+        m["experiment"].Session,
+        (
+            dict(animal_id=a, session=s, scan_path=f"S:\\standin\\{a}_{s}")
+            for a, s in sessions
+        ),
+    )
+    _insert(m["experiment"].Scan, keys)
+    _insert(
+        m["collection"].CuratedScan,
+        (
+            dict(k, study_name="standin", scan_purpose="platinum_plus", score=4)
+            for k in keys
+        ),
+    )
+    stacks = [dict(animal_id=a, session=s, stack_idx=1) for a, s in sessions]
+    _insert(m["experiment"].Stack, stacks)
+    _insert(m["stack"].CorrectionChannel, (dict(s, channel=1) for s in stacks))
+    _insert(m["stack"].CorrectedStack, (dict(s, volume_id=1) for s in stacks))
+
+    # completion stages: heavy scans are complete, the rest at random
+    stage = np.r_[np.full(n_heavy, 4), rng.integers(0, 5, max(n_scans - n_heavy, 0))]
+    pipes = ["meso" if i % 3 else "reso" for i in range(n_scans)]
+    methods = dict(pipe_version=1, segmentation_method=6, spike_method=6)
+    _insert(
+        m["fuse"].ScanSet,
+        (
+            dict(k, pipe_version=1, segmentation_method=6, pipe=p)
+            for k, p in zip(keys, pipes)
+        ),
+    )
+    for pipe_name in ("meso", "reso"):
+        pipe = m[pipe_name]
+        nf = n_fields if pipe_name == "meso" else 1
+        scans = [k for k, p in zip(keys, pipes) if p == pipe_name]
+        stages = stage[[p == pipe_name for p in pipes]]
+        fields = [dict(k, pipe_version=1, field=f) for k in scans for f in range(1, nf + 1)]
+        field_stage = np.repeat(stages, nf)
+        _insert(pipe.ScanInfo, (dict(k, pipe_version=1, nfields=nf) for k in scans))
+        _insert(pipe.ScanInfo.Field, fields)
+        _insert(pipe.Quality, (dict(k, pipe_version=1) for k in scans))
+        done = [f for f, s in zip(fields, field_stage) if s >= 1]
+        _insert(pipe.CorrectionChannel, (dict(f, channel=1) for f in done))
+        _insert(pipe.RasterCorrection, done)
+        _insert(pipe.MotionCorrection, done)
+        _insert(pipe.SummaryImages, done)
+        done = [dict(f, segmentation_method=6) for f, s in zip(fields, field_stage) if s >= 2]
+        for table in (pipe.Segmentation, pipe.Fluorescence, pipe.MaskClassification, pipe.ScanSet):
+            _insert(table, done)
+        _insert(pipe.Activity, (dict(f, spike_method=6) for f in done))
+        _insert(
+            pipe.ScanDone,
+            (dict(k, **methods) for k, s in zip(scans, stages) if s >= 2),
+        )
+        # registration tasks from stage 3, registration over time from stage 4
+        reg = [
+            dict(
+                animal_id=f["animal_id"],
+                stack_session=f["session"],
+                stack_idx=1,
+                volume_id=1,
+                stack_channel=1,
+                scan_session=f["session"],
+                scan_idx=f["scan_idx"],
+                scan_channel=1,
+                field=f["field"],
+                registration_method=5,
+            )
+            for f, s in zip(fields, field_stage)
+            if s >= 3
+        ]
+        _insert(m["stack"].RegistrationTask, reg)
+        _insert(m["stack"].Registration, reg)
+
+    heavy = keys[:n_heavy]
+    for i, key in enumerate(heavy):
+        # registration over time
+        rot = m["stack"].RegistrationTask & dict(
+            animal_id=key["animal_id"], scan_session=key["session"], scan_idx=key["scan_idx"]
+        )
+        rot_keys = rot.fetch("KEY")
+        _insert(m["stack"].RegistrationOverTimeTask, rot_keys)
+        _insert(m["stack"].RegistrationOverTime, rot_keys)
+        frames = np.arange(rot_frames)
+        for rot_key in rot_keys:
+            reg_z = np.cumsum(rng.normal(0, 0.1, rot_frames))
+            _insert(
+                m["stack"].RegistrationOverTime.Affine,
+                (dict(rot_key, frame_num=int(f), reg_z=float(z)) for f, z in zip(frames, reg_z)),
+            )
+
+        # treadmill at 100 Hz, with a few dropouts
+        time = np.arange(treadmill_samples) / 100
+        vel = np.abs(np.cumsum(rng.normal(0, 0.5, treadmill_samples)))
+        vel[rng.choice(treadmill_samples, treadmill_samples // 1000)] = np.nan
+        m["treadmill"].Treadmill.insert1(
+            dict(
+                key,
+                treadmill_raw=np.cumsum(np.nan_to_num(vel)) / 100,
+                treadmill_time=time,
+                treadmill_vel=vel,
+            ),
+            skip_duplicates=True,
+        )
+
+        # pupil fits of every frame, about 5% of them failed
+        tracking = dict(key, tracking_method=2)
+        m["pupil"].Tracking.insert1(tracking, skip_duplicates=True)
+        m["pupil"].Tracking.Deeplabcut.insert1(
+            dict(tracking, cropped_x0=0, cropped_x1=64, cropped_y0=0, cropped_y1=48),
+            skip_duplicates=True,
+        )
+        fitted = dict(tracking, fitting_method=2)
+        m["pupil"].FittedPupil.insert1(fitted, skip_duplicates=True)
+        failed = rng.random(pupil_frames) < 0.05
+        x = 32 + 10 * np.sin(np.arange(pupil_frames) / 50)
+        _insert(
+            m["pupil"].FittedPupil.Circle,
+            (
+                dict(fitted, frame_id=j, center=None, radius=None)
+                if failed[j]
+                else dict(fitted, frame_id=j, center=np.array([x[j], 24.0]), radius=8.0)
+                for j in range(pupil_frames)
+            ),
+        )
+        _insert(
+            m["pupil"].FittedPupil.EyePoints,
+            (
+                dict(
+                    fitted,
+                    label=f"eye_{p:02d}",
+                    x=x + 8 * np.cos(p * np.pi / 8),
+                    y=24 + 8 * np.sin(p * np.pi / 8),
+                )
+                for p in range(16)
+            ),
+        )
+        folder = Path(utils.get_linux_folder(key))
+        folder.mkdir(parents=True, exist_ok=True)
+        write_video(folder / utils.beh_filename(key), pupil_frames, seed=i)
+
+    # jobs: mostly errors of scans in the batch, some of other keys
+    schemas = ["treadmill", "pupil", "meso", "reso", "fuse", "experiment"]
+    messages = [
+        "LostConnectionError: Connection was lost during a transaction.",
+        "OperationalError: (1205, 'Lock wait timeout exceeded; try restarting transaction')",
+        "ValueError: stand-in failure",
+    ]
+    for n, name in enumerate(schemas):
+        rows = []
+        for j in range(n * n_jobs // len(schemas), (n + 1) * n_jobs // len(schemas)):
+            key = dict(keys[j % n_scans]) if j % 4 else dict(animal_id=9999, session=j, scan_idx=1)
+            key["field"] = 1 + j // n_scans % n_fields
+            rows.append(
+                dict(
+                    table_name=f"__table_{j % 7}",
+                    key_hash=key_hash(key),
+                    status="reserved" if j % 5 == 0 else "error",
+                    key=key,
+                    error_message=messages[j % len(messages)],
+                )
+            )
+        _insert(m[name].schema.jobs, rows)
+    return keys, heavy
@@ -0,0 +1,8 @@
+#!/bin/bash
+cd /src || {
+	echo "cd failed"
+	exit
+}
+pip install datajoint
+pip install -e pipeline-qc
+python -m qc.schemas "$@"
@@ -1,23 +1,192 @@
 from .logging import logger
+from .report import Report, thumbnail
 from .scan import Scan
+from .status import BatchStatus, SCAN_ATTRS, REG_SCAN_ATTRS, count_by, scan_id
+from . import cache
+from . import instrument
+from . import jobs
+from . import stack
+from . import utils
+from . import virtual as V
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import fields
+from functools import partial
+from itertools import repeat
+import multiprocessing as mp
+import os
+import matplotlib
+from matplotlib import pyplot as plt
+import datajoint as dj
 import pandas as pd
 from tqdm import tqdm
 
+
+def _init_worker():
+    # headless rendering and a connection of the worker's own; the Connection
+    # object inherited from the parent is reused so virtual modules stay bound
+    matplotlib.use("Agg")
+    dj.conn().connect()
+    # the parent's Recorder is inherited but does not collect from here, see
+    # `run_scan_qc_recorded`
+    instrument._active = None
+
+
+def run_scan_qc(key, filepath, steps, video_path=None, thumbnail_dpi=None, **kwargs):
+    """
+    Run the QC of one scan (a Scan or its key), closing its figures, and return
+    a record per step. `kwargs` are passed to `Scan.iter_qc`. `video_path` is
+    its behavior video, if already resolved. With `thumbnail_dpi`, records
+    with a figure carry its PNG bytes at that dpi as "thumbnail", for a
+    `report.Report`.
+    """
+    rec = []
+    scan = key if isinstance(key, Scan) else Scan(**key)
+    if video_path is not None:
+        scan.preload(beh_h5_filepath=video_path)
+    key = scan.key
+    try:
+        for r, fig in scan.iter_qc(filepath=filepath, steps=steps, **kwargs):
+            rec.append(r)
+            if fig is not None:
+                if thumbnail_dpi is not None:
+                    r["thumbnail"] = thumbnail(fig, thumbnail_dpi)
+                plt.close(fig)
+    except Exception as e:
+        logger.error(f"Failed to run qc for {key}: {e}")
+        rec.append(
+            {**key, "step": None, "status": "error", "file": None,
+             "error": f"{type(e).__name__}: {e}"}
+        )
+    return rec
+
+
+def run_scan_qc_recorded(key, filepath, steps, video_path=None, queries=True, **kwargs):
+    """`run_scan_qc` under a Recorder of its own; returns (records, phase records)."""
+    with instrument.Recorder(queries=queries) as recorder:
+        rec = run_scan_qc(key, filepath, steps, video_path, **kwargs)
+    return rec, recorder.records
+
+
+def prefetch_scan_qc(scan, filepath, steps, **kwargs):
+    """`Scan.prefetch_qc`, with any failure reported as the error of every step."""
+    try:
+        return scan.prefetch_qc(filepath, steps, **kwargs)
+    except Exception as e:
+        return {step: dict(inputs=None, data=None, error=e) for step in steps.split("-")}
+
+
+def iter_prefetched(items, fetch, depth=2, max_bytes=2e9):
+    """
+    Yield (item, fetch(item)) in order while a background thread fetches up to
+    `depth` items ahead of the one being consumed. No new fetch starts while
+    the fetched payloads waiting to be consumed hold more than `max_bytes` of
+    arrays.
+    A single thread is used: the DataJoint connection is not thread-safe, and
+    the caller is expected to do no queries of its own meanwhile.
+    """
+    items, end = iter(items), object()
+    pending = deque()
+    exhausted = False
+    with ThreadPoolExecutor(1, thread_name_prefix="qc-prefetch") as pool:
+
+        def refill():
+            nonlocal exhausted
+            while not exhausted and len(pending) < depth:
+                queued = sum(utils.nbytes(f.result()) for _, f in pending if f.done())
+                if pending and queued > max_bytes:
+                    break
+                item = next(items, end)
+                if item is end:
+                    exhausted = True
+                    break
+                pending.append((item, pool.submit(fetch, item)))
+
+        refill()
+        while pending:
+            item, future = pending.popleft()
+            # the next fetches run while this item is consumed
+            refill()
+            yield item, future.result()
+
+
+def summarize_qc(results):
+    """Number of scans per step that were rebuilt, skipped or failed."""
+    return (
+        results.groupby(["step", "status"]).size().unstack("status", fill_value=0)
+    )
+
+
 class Batch:
-    def __init__(self, scan_keys) -> None:
-        self.scans = [
-            Scan(
-                animal_id=key["animal_id"],
-                session=key["session"],
-                scan_idx=key["scan_idx"],
-            )
-            for key in scan_keys
-        ]
+    def __init__(self, scan_keys, jobs_ttl=None, chunk_size=500) -> None:
+        """
+        `scan_keys` is a list of scans (keys or Scan objects) or a query of
+        scans, e.g. a CuratedScan restriction. The keys of a query are fetched
+        when first needed, or `chunk_size` at a time by `iter_chunks` and the
+        other iter_* methods, which work through the batch one chunk at a time.
+        """
+        if isinstance(scan_keys, dj.expression.QueryExpression):
+            self.query = scan_keys
+            self._scans = None
+        else:
+            self.query = None
+            self._scans = [self.scan(key) for key in scan_keys]
+        self.chunk_size = chunk_size
+        # with a ttl, jobs tables are shared across calls until they expire
+        self.jobs_snapshot = None if jobs_ttl is None else jobs.JobsSnapshot(ttl=jobs_ttl)
+
+    @staticmethod
+    def scan(key):
+        if isinstance(key, Scan):
+            return key
+        return Scan(
+            animal_id=key["animal_id"],
+            session=key["session"],
+            scan_idx=key["scan_idx"],
+        )
+
+    @property
+    def scans(self):
+        if self._scans is None:
+            keys = self.scan_query.fetch("KEY", order_by=list(SCAN_ATTRS))
+            self._scans = [self.scan(key) for key in keys]
+        return self._scans
+
+    @property
+    def scan_query(self):
+        return dj.U(*SCAN_ATTRS) & self.query
 
     @property
     def keys(self):
         return [s.key for s in self.scans]
 
+    def iter_chunks(self, chunk_size=None):
+        """Sub-batches of `chunk_size` scans, fetching the keys of a query page by page."""
+        chunk_size = chunk_size or self.chunk_size
+        if self.query is None or self._scans is not None:
+            pages = (
+                self.scans[i : i + chunk_size]
+                for i in range(0, len(self.scans), chunk_size)
+            )
+        else:
+            pages = self._iter_pages(chunk_size)
+        for scans in pages:
+            chunk = Batch(scans, chunk_size=chunk_size)
+            chunk.jobs_snapshot = self.jobs_snapshot
+            yield chunk
+
+    def _iter_pages(self, chunk_size):
+        offset = 0
+        while True:
+            keys = self.scan_query.fetch(
+                "KEY", order_by=list(SCAN_ATTRS), limit=chunk_size, offset=offset
+            )
+            if len(keys):
+                yield keys
+            if len(keys) < chunk_size:
+                return
+            offset += chunk_size
+
     @property
     def stacks(self):
         return [s.stack for s in self.scans]
@@ -35,89 +204,372 @@ class Batch:
         return pd.DataFrame.from_records(rec)
     
     def fill_auto_processing(self):
-        for s in self.scans:
-            s.fill_auto_processing()
+        """
+        Insert AutoProcessing for every scan without it, replacing rows of the
+        same scan that conflict with its key, in one transaction. Returns a
+        record per scan: "inserted", "replaced" or "skipped" (already there).
+        """
+        table = V.experiment.AutoProcessing
+        keys = self.keys
+        present = set(zip(*(table & keys).fetch(*SCAN_ATTRS))) if keys else set()
+        pending = [k for k in keys if scan_id(k) not in present]
+        scan_keys = [{a: k[a] for a in SCAN_ATTRS} for k in pending]
+        report = {scan_id(k): "skipped" for k in keys}
+        if pending:
+            conflicting = table & scan_keys
+            replaced = set(zip(*conflicting.fetch(*SCAN_ATTRS)))
+            with dj.conn().transaction:
+                conflicting.delete_quick()
+                table.insert(
+                    [{**k, "priority": 100, "autosegment": 1} for k in pending],
+                    ignore_extra_fields=True,
+                )
+            for k in pending:
+                report[scan_id(k)] = "replaced" if scan_id(k) in replaced else "inserted"
+        logger.info(f"AutoProcessing inserted for {len(pending)} of {len(keys)} scans")
+        return pd.DataFrame.from_records(
+            [{**k, "status": report[scan_id(k)]} for k in keys]
+        )
 
-    def delete_errors(self, errors=None):
+    def get_jobs_snapshot(self, status=None):
+        """The shared jobs snapshot if any, else a new one restricted to `status`."""
+        return self.jobs_snapshot or jobs.JobsSnapshot(status=status)
+
+    def delete_errors(self, errors=None, bulk=False, dry_run=False):
+        snapshot = self.get_jobs_snapshot(status=["error"])
+        if bulk:
+            return jobs.delete_errors(
+                self.get_jobs_df(snapshot),
+                errors=jobs.default_errors if errors is None else errors,
+                bulk=True,
+                dry_run=dry_run,
+            )
         for s in self.scans:
             if errors is None:
-                s.delete_errors()
+                s.delete_errors(snapshot=snapshot)
             else:
-                s.delete_errors(errors)
+                s.delete_errors(errors, snapshot=snapshot)
     
-    def delete_stack_errors(self, errors=None):
+    def delete_stack_errors(self, errors=None, bulk=False, dry_run=False):
+        snapshot = self.get_jobs_snapshot(status=["error"])
+        if bulk:
+            return jobs.delete_errors(
+                self.get_stack_jobs_df(snapshot),
+                errors=jobs.default_errors if errors is None else errors,
+                bulk=True,
+                dry_run=dry_run,
+            )
         for s in self.scans:
             if errors is None:
-                s.delete_stack_errors()
+                s.delete_stack_errors(snapshot=snapshot)
             else:
-                s.delete_stack_errors(errors)
+                s.delete_stack_errors(errors, snapshot=snapshot)
 
-    def fill_registration_task(self, force=False):
+    def fill_tasks(self, task_table, force=False):
+        """
+        Schedule the registration tasks of every scan in `task_table` in three
+        phases: validate all scans with `BatchStatus.stack_reg_task`, insert
+        the tasks of the valid scans not fully scheduled yet in one insert
+        inside a transaction (after a single confirmation unless `force`),
+        and return a record per scan with its status ("inserted", "skipped"
+        when already scheduled, "invalid" or "declined"), the number of task
+        rows inserted and the error of invalid scans.
+        """
+        status = self.status
+        tasks, errors = status.stack_reg_task
+        report = {
+            sid: dict(status="invalid", rows=0, error=f"{type(e).__name__}: {e}")
+            for sid, e in errors.items()
+        }
+        rows = []
+        for pipe_name, reg_task in tasks.items():
+            scheduled = count_by(task_table & reg_task, REG_SCAN_ATTRS)
+            pending = []
+            for key in status.pipes[pipe_name]:
+                sid = scan_id(key)
+                if sid in report:
+                    continue
+                if scheduled.get(sid, 0) == status.nfields.get(sid, 0):
+                    report[sid] = dict(status="skipped", rows=0, error=None)
+                else:
+                    pending.append(dict(zip(REG_SCAN_ATTRS, sid)))
+            if pending:
+                rows += (reg_task & pending).fetch(as_dict=True)
+        counts = Counter(tuple(r[a] for a in REG_SCAN_ATTRS) for r in rows)
+        for sid, n in counts.items():
+            report[sid] = dict(status="inserted", rows=int(n), error=None)
+        name = task_table.__name__
+        if rows and not force:
+            print(f"{len(rows)} {name} rows for {len(counts)} scans")
+            if input(f"Confirm {name} for DataJoint insert. (y/n): ") != "y":
+                for sid in counts:
+                    report[sid] = dict(status="declined", rows=0, error=None)
+                rows = []
+        if rows:
+            with dj.conn().transaction:
+                task_table.insert(rows, ignore_extra_fields=True, skip_duplicates=True)
         for s in self.scans:
-            logger.info(f"Inserting registration task for {s.key}")
-            try:
-                s.fill_registration_task(force=force)
-            except Exception as e:
-                logger.error(f"Failed to insert registration task for {s.key}: {e}")
+            s.invalidate("n_reg_task", "n_rot_task")
+        logger.info(f"{name} inserted for {len(counts) if rows else 0} of {len(self.keys)} scans")
+        return pd.DataFrame.from_records(
+            [{**k, **report[scan_id(k)]} for k in self.keys]
+        )
+
+    def fill_registration_task(self, force=False):
+        return self.fill_tasks(V.stack.RegistrationTask, force=force)
 
     def fill_rot_task(self, force=False):
-        for s in self.scans:
-            logger.info(f"Inserting RegistrationOverTime task for {s.key}")
-            try:
-                s.fill_rot_task(force=force)
-            except Exception as e:
-                logger.error(
-                    f"Failed to insert RegistrationOverTime task for {s.key}: {e}"
-                )
+        return self.fill_tasks(V.stack.RegistrationOverTimeTask, force=force)
+
+    def iter_fill_auto_processing(self, chunk_size=None):
+        for chunk in self.iter_chunks(chunk_size):
+            yield chunk.fill_auto_processing()
+
+    def iter_fill_registration_task(self, force=False, chunk_size=None):
+        for chunk in self.iter_chunks(chunk_size):
+            yield chunk.fill_registration_task(force=force)
+
+    def iter_fill_rot_task(self, force=False, chunk_size=None):
+        for chunk in self.iter_chunks(chunk_size):
+            yield chunk.fill_rot_task(force=force)
 
     @property
     def jobs_df(self):
-        dfs = []
-        for s in self.scans:
-            df = s.jobs_df
-            for k in s.key:
-                df[k] = s.key[k]
-            dfs.append(df)
-        return pd.concat(dfs).set_index(["animal_id", "session", "scan_idx"])
+        return self.get_jobs_df()
+
+    def get_jobs_df(self, snapshot=None):
+        snapshot = snapshot or self.get_jobs_snapshot()
+        return (
+            snapshot
+            .split(self.keys, self.keys, schema_names=list(jobs.jobs_schemas))
+            .set_index(["animal_id", "session", "scan_idx"])
+        )
 
     @property
     def stack_jobs_df(self):
-        dfs = []
-        for s in self.scans:
-            df = s.stack_jobs_df
-            for k in s.key:
-                df[k] = s.key[k]
-            dfs.append(df)
-        return pd.concat(dfs).set_index(["animal_id", "session", "scan_idx"])
+        return self.get_stack_jobs_df()
+
+    def get_stack_jobs_df(self, snapshot=None):
+        snapshot = snapshot or self.get_jobs_snapshot()
+        targets, owners = self.status.stack_jobs_targets
+        return (
+            snapshot
+            .split(targets, owners, schema_names=["stack"])
+            .set_index(["animal_id", "session", "scan_idx"])
+        )
+
+    @property
+    def status(self):
+        return BatchStatus(self.keys)
 
     @property
     def scan_done(self):
-        rec = []
-        for s in self.scans:
-            rec.append({**s.key, "done": s.scan_done})
-        return pd.DataFrame.from_records(rec)
+        return self.status.scan_done
 
     @property
     def stack_reg_done(self):
-        rec = []
-        for s in self.scans:
-            rec.append({**s.key, "done": s.stack_reg_done})
-        return pd.DataFrame.from_records(rec)
+        return self.status.stack_reg_done
 
     @property
     def stack_rot_done(self):
-        rec = []
-        for s in self.scans:
-            rec.append({**s.key, "done": s.stack_rot_done})
-        return pd.DataFrame.from_records(rec)
+        return self.status.stack_rot_done
+
+    @property
+    def progress(self):
+        """Rows and reserved/error jobs of every pipeline table per scan, see `BatchStatus.progress`."""
+        jobs_df = self.get_jobs_snapshot().split(
+            self.keys, self.keys, schema_names=[*jobs.jobs_schemas, "stack"]
+        )
+        return self.status.progress(jobs_df)
 
-    def run_qc(self, filepath="/mnt/lab/users/zhuokun/pipeline_qc"):
-        for s in tqdm(self.scans):
-            try:
-                s.run_qc(filepath=filepath)
-            except Exception as e:
-                logger.error(f"Failed to run qc for {s.key}: {e}")
-        return
+    def iter_scan_done(self, chunk_size=None):
+        for chunk in self.iter_chunks(chunk_size):
+            yield chunk.scan_done
+
+    def iter_stack_reg_done(self, chunk_size=None):
+        for chunk in self.iter_chunks(chunk_size):
+            yield chunk.stack_reg_done
+
+    def iter_stack_rot_done(self, chunk_size=None):
+        for chunk in self.iter_chunks(chunk_size):
+            yield chunk.stack_rot_done
+
+    def fetch_rot_qc(self, chunk_size=500):
+        """
+        rot QC data of every scan whose RegistrationOverTime is done, keyed by
+        (animal_id, session, scan_idx), in a few queries for the whole batch.
+        Scans that cannot be registered (see `BatchStatus.stack_reg_task`) are
+        left out.
+        """
+        status = self.status
+        done = status.valid_stack_rot_done()
+        done = done[done["done"].apply(lambda d: d is True)]
+        if done.empty:
+            return {}
+        tasks, _ = status.stack_reg_task
+        rot_fields = pd.concat(
+            [
+                (
+                    V.stack.RegistrationOverTime
+                    & reg_task
+                    & done[["animal_id", "session", "scan_idx"]]
+                    .rename(columns={"session": "scan_session"})
+                    .to_dict("records")
+                )
+                .fetch(format="frame")
+                .reset_index()
+                for reg_task in tasks.values()
+            ],
+            ignore_index=True,
+        )
+        data = stack.load_rot_qc(rot_fields, chunk_size=chunk_size)
+        scan_attrs = [stack.ROT_ATTRS.index(k) for k in ("animal_id", "scan_session", "scan_idx")]
+        return {tuple(rot_key[i] for i in scan_attrs): d for rot_key, d in data.items()}
+
+    def run_qc(
+        self,
+        filepath=None,
+        steps="pupil-treadmill-rot",
+        workers=None,
+        fmt="pdf",
+        dpi=None,
+        rasterize=False,
+        force=False,
+        prefetch=0,
+        max_prefetch_bytes=2e9,
+        render=True,
+        report=None,
+    ):
+        """
+        Run the QC of every scan and return a frame with one record per scan and
+        step, in scan order. With `workers` > 1, scans are spread over a pool of
+        forked processes, each with its own connection and a headless backend.
+        With `prefetch` > 0 (single process), the data of the next `prefetch`
+        scans is fetched in the background while the current one renders,
+        holding at most about `max_prefetch_bytes` of fetched arrays.
+        `fmt`, `dpi` and `rasterize` set the figure output and steps that are up
+        to date are skipped unless `force`, see `Scan.iter_qc`.
+        Records carry the metrics of their step; without `render`, only the
+        metrics are computed and no figure is made.
+        Phases are timed while an `instrument.Recorder` is active, including
+        those run in worker processes; with `prefetch`, only the fetch phases
+        measure queries and peak RSS, the other phases record None for them.
+        With `report`, a `report.Report` or the path of one (".html" or
+        ".pdf"), a thumbnail of every figure is streamed into it as scans
+        finish. A report given by path is written at the end; a Report is
+        left open for more records, to be closed by the caller.
+        """
+        own_report = isinstance(report, (str, os.PathLike))
+        if own_report:
+            report = Report(report)
+        options = dict(fmt=fmt, dpi=dpi, rasterize=rasterize, force=force, render=render)
+        thumbnail_dpi = None if report is None else report.dpi
+        qc = partial(run_scan_qc, thumbnail_dpi=thumbnail_dpi, **options)
+        data_cache = cache.active()
+        offline = data_cache is not None and not data_cache.validate
+        # offline, cached scans need no path, and the others resolve their own
+        if render and "pupil" in steps.split("-") and not offline:
+            video_paths = self.preload_beh_h5_filepaths()
+        else:
+            video_paths = [None] * len(self.scans)
+
+        def collect(results):
+            rec = []
+            for res in tqdm(results, total=len(self.scans)):
+                for r in res:
+                    thumb = r.pop("thumbnail", None)
+                    if report is not None and r["status"] != "measured":
+                        report.add(r, thumb)
+                rec += res
+            return rec
+
+        if (workers is None or workers <= 1) and prefetch > 0:
+            prefetched = iter_prefetched(
+                self.scans,
+                partial(prefetch_scan_qc, filepath=filepath, steps=steps, **options),
+                depth=prefetch,
+                max_bytes=max_prefetch_bytes,
+            )
+            # the prefetching thread has the connection and the peak RSS to itself
+            with instrument.without_queries():
+                rec = collect(qc(s, filepath, steps, prefetched=p) for s, p in prefetched)
+        elif workers is None or workers <= 1:
+            rec = collect(qc(scan, filepath, steps) for scan in self.scans)
+        else:
+            with ProcessPoolExecutor(
+                workers, mp_context=mp.get_context("fork"), initializer=_init_worker
+            ) as pool:
+                recorder = instrument.active()
+                if recorder is None:
+                    results = pool.map(
+                        qc, self.keys, repeat(filepath), repeat(steps), video_paths
+                    )
+                else:
+                    # workers record their own phases and send them back
+                    recorded = pool.map(
+                        partial(
+                            run_scan_qc_recorded,
+                            queries=recorder.queries,
+                            thumbnail_dpi=thumbnail_dpi,
+                            **options,
+                        ),
+                        self.keys,
+                        repeat(filepath),
+                        repeat(steps),
+                        video_paths,
+                    )
+                    results = (recorder.add(phases) or res for res, phases in recorded)
+                rec = collect(results)
+        columns = [*(f.name for f in fields(Scan)), "step", "status", "file", "error"]
+        results = pd.DataFrame.from_records(rec)
+        results = results.reindex(
+            columns=[*columns, *results.columns.difference(columns, sort=False)]
+        )
+        logger.info(f"QC summary:\n{summarize_qc(results)}")
+        if own_report:
+            report.close()
+        return results
+
+    def preload_beh_h5_filepaths(self):
+        """
+        Resolve the behavior video of every scan with one query (see
+        `utils.get_beh_h5_filepaths`) and preload it into the scans. Returns
+        the paths, or None for every scan if they cannot be resolved in bulk,
+        leaving each scan to resolve its own.
+        """
+        try:
+            paths = utils.get_beh_h5_filepaths(self.keys)
+        except Exception as e:
+            logger.warning(f"Could not resolve the behavior videos in bulk: {e}")
+            return [None] * len(self.scans)
+        for scan, path in zip(self.scans, paths):
+            scan.preload(beh_h5_filepath=path)
+        return paths
+
+    def iter_run_qc(self, chunk_size=None, report=None, **kwargs):
+        """
+        `run_qc` one chunk at a time, yielding the results of each. With
+        `report`, one report covers every chunk, and one given by path is
+        written once the last chunk is done.
+        """
+        own_report = isinstance(report, (str, os.PathLike))
+        if own_report:
+            report = Report(report)
+        for chunk in self.iter_chunks(chunk_size):
+            yield chunk.run_qc(report=report, **kwargs)
+        if own_report:
+            report.close()
+
+    def qc_metrics(self, steps="pupil-treadmill-rot", workers=None, prefetch=0):
+        """QC metrics without rendering, one row per scan, indexed by scan key."""
+        results = self.run_qc(
+            steps=steps, workers=workers, prefetch=prefetch, render=False
+        )
+        key = [f.name for f in fields(Scan)]
+        metrics = results.columns.difference(
+            [*key, "step", "status", "file", "error"], sort=False
+        )
+        return results.groupby(key, sort=False)[list(metrics)].first()
 
 
 # %%
@@ -146,8 +598,5 @@ if __name__ == "__main__":
         ), 
     ]
 
-    scan_keys = (V.collection.CuratedScan & scan_query).fetch(
-        "animal_id", "session", "scan_idx", as_dict=True
-    )
-    test_batch = Batch(scan_keys)
+    test_batch = Batch(V.collection.CuratedScan & scan_query)
 # %%
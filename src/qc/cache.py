@@ -0,0 +1,158 @@
+"""
+Local cache of the data fetched for the QC figures.
+
+Each entry holds the fetch-phase dict of one QC step of one scan: arrays as
+`.npy` files, memory-mapped when read back, and everything else in
+`entry.json` with the upstream fingerprint it was fetched at. Entries are
+addressed by step name and primary key, and evicted least recently used
+first once the cache outgrows `max_bytes`.
+
+    cache.enable("/scratch/qc_cache", max_bytes=50e9)
+    batch.run_qc()                       # fetched once, cached
+    cache.enable("/scratch/qc_cache", validate=False)
+    batch.run_qc(dpi=150, force=True)    # re-rendered without the database
+
+Setting $PIPELINE_QC_CACHE enables a cache at that folder on first use.
+"""
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from pathlib import Path
+import numpy as np
+from .logging import logger
+from .manifest import normalize
+
+_active = None
+
+
+class ArrayCache:
+    """
+    With `validate`, an entry is used only if it was fetched at the current
+    upstream fingerprint; without, entries are used as they are and no
+    fingerprint needs to be queried (offline mode).
+    """
+
+    filename = "entry.json"
+
+    def __init__(self, root, max_bytes=20e9, validate=True):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.validate = validate
+        self.hits = 0
+        self.misses = 0
+
+    def folder(self, name, key):
+        digest = hashlib.sha1(json.dumps(normalize(key), sort_keys=True).encode())
+        return self.root / name / digest.hexdigest()
+
+    def entry(self, name, key):
+        """The metadata of the entry of `name` and `key`, None if missing."""
+        path = self.folder(name, key) / self.filename
+        try:
+            return json.loads(path.read_text())
+        except FileNotFoundError:
+            return None
+
+    def fingerprint(self, name, key):
+        """The upstream fingerprint of the entry of `name` and `key`, if any."""
+        entry = self.entry(name, key)
+        return None if entry is None else entry["fingerprint"]
+
+    def get(self, name, key, fingerprint=None):
+        """
+        The cached data of `name` and `key`, or None if it is missing or, when
+        validating, was fetched at another `fingerprint`.
+        """
+        folder = self.folder(name, key)
+        entry = self.entry(name, key)
+        if entry is None or (
+            self.validate and entry["fingerprint"] != normalize(fingerprint)
+        ):
+            self.misses += 1
+            return None
+        try:
+            data = dict(entry["values"])
+            for field in entry["arrays"]:
+                data[field] = np.load(folder / f"{field}.npy", mmap_mode="r")
+        except FileNotFoundError:
+            # evicted meanwhile
+            self.misses += 1
+            return None
+        # the modification time of the entry orders eviction
+        os.utime(folder / self.filename)
+        self.hits += 1
+        return data
+
+    def put(self, name, key, data, fingerprint=None):
+        folder = self.folder(name, key)
+        tmp = folder.with_name(f".{folder.name}.{uuid.uuid4().hex}")
+        tmp.mkdir(parents=True)
+        entry = dict(key=normalize(key), fingerprint=normalize(fingerprint), arrays=[], values={})
+        for field, value in data.items():
+            if isinstance(value, np.ndarray):
+                # object arrays (e.g. labels) are stored as strings to stay mappable
+                np.save(tmp / f"{field}.npy", value.astype(str) if value.dtype == object else value)
+                entry["arrays"].append(field)
+            else:
+                entry["values"][field] = value
+        entry["values"] = normalize(entry["values"])
+        (tmp / self.filename).write_text(json.dumps(entry))
+        # replace any previous entry in one step for concurrent readers
+        if folder.exists():
+            old = folder.with_name(f".{folder.name}.{uuid.uuid4().hex}")
+            folder.rename(old)
+            shutil.rmtree(old, ignore_errors=True)
+        tmp.rename(folder)
+        self.evict()
+
+    def entries(self):
+        """(last use, bytes, folder) of every entry."""
+        entries = []
+        for path in self.root.glob(f"*/*/{self.filename}"):
+            try:
+                used = path.stat().st_mtime
+                size = sum(f.stat().st_size for f in path.parent.iterdir())
+            except FileNotFoundError:
+                continue
+            entries.append((used, size, path.parent))
+        return entries
+
+    @property
+    def nbytes(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, max_bytes=None):
+        """Remove the least recently used entries until at most `max_bytes` remain."""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = sorted(self.entries(), key=lambda e: e[0])
+        total = sum(size for _, size, _ in entries)
+        for _, size, folder in entries:
+            if total <= max_bytes:
+                break
+            shutil.rmtree(folder, ignore_errors=True)
+            total -= size
+            logger.info(f"Evicted {folder} from the QC cache")
+
+    def clear(self):
+        self.evict(0)
+
+
+def enable(root, max_bytes=20e9, validate=True):
+    """Read QC data through an ArrayCache at `root` from now on."""
+    global _active
+    _active = ArrayCache(root, max_bytes=max_bytes, validate=validate)
+    return _active
+
+
+def disable():
+    global _active
+    _active = None
+
+
+def active():
+    """The ArrayCache in use, if any."""
+    if _active is None and os.environ.get("PIPELINE_QC_CACHE"):
+        enable(os.environ["PIPELINE_QC_CACHE"])
+    return _active
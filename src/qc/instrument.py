@@ -0,0 +1,301 @@
+"""
+Per-phase timing and resource use of the QC steps.
+
+    with instrument.Recorder(log="timings.jsonl") as recorder:
+        batch.run_qc()
+    recorder.frame()
+    recorder.summary()
+
+While a Recorder is active, `phase` blocks (fetch, decode, render and save of
+every step) record their wall time, DB queries, bytes sent by the DB and the
+peak RSS of the process. Phases nest, and the time, queries and bytes of
+inner phases are excluded from the outer one.
+
+    with instrument.QueryLog(slow=0.5) as log:
+        batch.stack_reg_done
+    log.frame()
+
+While a QueryLog is active, every query on the DataJoint connection is timed
+and counted under the `Scan`, `Batch` or `BatchStatus` method that issued it,
+and slow ones are logged with their SQL.
+"""
+import json
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+import datajoint as dj
+import pandas as pd
+from .logging import logger
+
+_active = None
+
+
+def active():
+    """The Recorder in effect, if any."""
+    return _active
+
+
+def session_status():
+    """Statements and bytes the DB has sent this session, including this query."""
+    rows = dj.conn().query(
+        "SHOW SESSION STATUS WHERE Variable_name IN ('Questions', 'Bytes_sent')"
+    ).fetchall()
+    status = {name: int(value) for name, value in rows}
+    return status["Questions"], status["Bytes_sent"]
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process since the last `reset_peak_rss`
+    (on Linux) or since it started, in MB.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+def reset_peak_rss():
+    """Reset the peak RSS to the current RSS; False where that is not supported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class Recorder:
+    """
+    Collects a record per phase while active (as a context manager, one at a
+    time). The peak RSS of a phase is the highest RSS of the process while
+    it ran, where the peak can be reset (Linux); elsewhere it is the peak of
+    the process so far. With `log`, records are also appended to that JSON-lines file as
+    they are made. Without `queries`, the DB is not asked for its counters.
+    The counters are read on the shared connection, which must not be used
+    from two threads at once, and the peak RSS is that of the whole process:
+    phases run under `without_queries` in a thread (the rendering thread of
+    `Batch.run_qc` with `prefetch`) neither read the counters nor reset the
+    peak, and record no queries, bytes or peak RSS.
+    """
+
+    def __init__(self, log=None, queries=True):
+        self.log = log
+        self.queries = queries
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __enter__(self):
+        global _active
+        assert _active is None, "Another Recorder is active"
+        _active = self
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        _active = None
+
+    def add(self, records):
+        with self._lock:
+            self.records.extend(records)
+            if self.log is not None:
+                with open(self.log, "a") as f:
+                    for rec in records:
+                        f.write(json.dumps(rec, default=str) + "\n")
+
+    @contextmanager
+    def phase(self, name, **labels):
+        stack = self._local.__dict__.setdefault("stack", [])
+        if stack:
+            labels = {**stack[-1]["labels"], **labels}
+        frame = dict(labels=labels, seconds=0.0, queries=0, bytes=0, peak_rss=0.0)
+        # the peak is process wide: resetting it from a thread running beside
+        # another one would cut short the peak of the other's phase
+        measuring = getattr(self._local, "queries", True)
+        if stack and measuring:
+            # the peak of the outer phase so far, before it is reset
+            stack[-1]["peak_rss"] = max(stack[-1]["peak_rss"], peak_rss())
+        stack.append(frame)
+        if measuring:
+            reset_peak_rss()
+        probing = self.queries and measuring
+        queries, nbytes = session_status() if probing else (0, 0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            end_queries, end_bytes = session_status() if probing else (0, 0)
+            if measuring:
+                frame["peak_rss"] = max(frame["peak_rss"], peak_rss())
+            stack.pop()
+            # each status query is counted once in the phase it closes and
+            # once in the parent of the phase it opens
+            probe = 1 if probing else 0
+            total = dict(
+                seconds=seconds,
+                queries=end_queries - queries,
+                bytes=end_bytes - nbytes,
+            )
+            if stack:
+                stack[-1]["seconds"] += total["seconds"]
+                stack[-1]["queries"] += total["queries"] + probe
+                stack[-1]["bytes"] += total["bytes"]
+                stack[-1]["peak_rss"] = max(stack[-1]["peak_rss"], frame["peak_rss"])
+            self.add(
+                [
+                    {
+                        **labels,
+                        "phase": name,
+                        "seconds": total["seconds"] - frame["seconds"],
+                        "queries": (
+                            total["queries"] - probe - frame["queries"] if probing else None
+                        ),
+                        "bytes": total["bytes"] - frame["bytes"] if probing else None,
+                        "peak_rss": frame["peak_rss"] if measuring else None,
+                    }
+                ]
+            )
+
+    @contextmanager
+    def without_queries(self):
+        """Phases of this thread do not measure queries or peak RSS in the block."""
+        self._local.queries = False
+        try:
+            yield
+        finally:
+            self._local.queries = True
+
+    def frame(self):
+        return pd.DataFrame.from_records(self.records)
+
+    def summary(self, quantiles=(0.5, 0.95)):
+        """p50/p95 (by default) of every phase of every step."""
+        return (
+            self.frame()
+            .groupby(["step", "phase"])[["seconds", "queries", "bytes", "peak_rss"]]
+            .quantile(list(quantiles))
+            .unstack()
+        )
+
+
+@contextmanager
+def phase(name, **labels):
+    """Record the enclosed block as phase `name` of the active Recorder, if any."""
+    if _active is None:
+        yield
+    else:
+        with _active.phase(name, **labels):
+            yield
+
+
+@contextmanager
+def without_queries():
+    """`Recorder.without_queries` of the active Recorder, if any."""
+    if _active is None:
+        yield
+    else:
+        with _active.without_queries():
+            yield
+
+
+# classes whose methods queries are charged to, rather than to their helpers
+CALLER_CLASSES = ("Scan", "Batch", "BatchStatus")
+
+
+def caller():
+    """
+    The innermost method of a `CALLER_CLASSES` object on the stack, as
+    "Class.method", so that queries made through helpers (properties,
+    `virtual`, `jobs`, ...) are charged to the QC method that needed them.
+    Otherwise the innermost `qc` function outside of this module, as
+    "Class.method" or "module.function".
+    """
+    frame = sys._getframe(2)
+    fallback = "<other>"
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if module.startswith("qc") and module != __name__:
+            self = frame.f_locals.get("self")
+            is_qc = self is not None and type(self).__module__.startswith("qc")
+            if is_qc and type(self).__name__ in CALLER_CLASSES:
+                return f"{type(self).__name__}.{frame.f_code.co_name}"
+            if fallback == "<other>":
+                fallback = (
+                    f"{type(self).__name__}.{frame.f_code.co_name}"
+                    if is_qc
+                    else f"{module}.{frame.f_code.co_name}"
+                )
+        frame = frame.f_back
+    return fallback
+
+
+class QueryLog:
+    """
+    Counts and times the queries of the DataJoint connection while active (as
+    a context manager), per `Scan`, `Batch` or `BatchStatus` method that
+    issued them, see `caller`. Queries slower
+    than `slow` seconds are logged with their SQL, truncated to `max_sql`
+    characters, and kept in `slow_queries`.
+    """
+
+    def __init__(self, slow=1.0, max_sql=1000, conn=None):
+        self.slow = slow
+        self.max_sql = max_sql
+        self.conn = conn
+        self.stats = {}
+        self.slow_queries = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.conn = self.conn or dj.conn()
+        assert "query" not in vars(self.conn), "Another QueryLog is active"
+        query = self.conn.query
+
+        def timed_query(sql, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return query(sql, *args, **kwargs)
+            finally:
+                self.add(caller(), sql, time.perf_counter() - start)
+
+        # shadows Connection.query on this connection only
+        self.conn.query = timed_query
+        return self
+
+    def __exit__(self, *exc):
+        del self.conn.query
+
+    def add(self, method, sql, seconds):
+        with self._lock:
+            stats = self.stats.setdefault(
+                method, dict(queries=0, seconds=0.0, max_seconds=0.0)
+            )
+            stats["queries"] += 1
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            if seconds > self.slow:
+                sql = " ".join(sql.split())[: self.max_sql]
+                self.slow_queries.append(dict(method=method, seconds=seconds, sql=sql))
+                logger.warning(f"Slow query ({seconds:.2f}s) from {method}: {sql}")
+
+    def frame(self):
+        """Queries, total and longest time per method, most queries first."""
+        return (
+            pd.DataFrame.from_dict(
+                self.stats,
+                orient="index",
+                columns=["queries", "seconds", "max_seconds"],
+            )
+            .rename_axis("method")
+            .sort_values("queries", ascending=False)
+        )
@@ -1,17 +1,32 @@
+import time
+from collections.abc import Mapping
 import pandas as pd
 from qc import virtual as V
+from .logging import logger
 import numpy as np
 
-jobs_schemas = {
-    "treadmill": V.treadmill,
-    "pupil": V.pupil,
-    "meso": V.meso,
-    "reso": V.reso,
-    "fuse": V.fuse,
-    "experiment": V.experiment,
-    "collection": V.collection,
-    "stimulus": V.stimulus,
-}
+class VirtualSchemas(Mapping):
+    '''
+    Mapping of schema names to their virtual modules in `qc.virtual`, resolved
+    on access so that no schema is introspected before it is used.
+    '''
+    def __init__(self, names):
+        self.names = list(names)
+
+    def __getitem__(self, name):
+        if name not in self.names:
+            raise KeyError(name)
+        return getattr(V, name)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+jobs_schemas = VirtualSchemas(
+    ["treadmill", "pupil", "meso", "reso", "fuse", "experiment", "collection", "stimulus"]
+)
 
 def rec_to_dict(rec):
     if isinstance(rec, dict):
@@ -36,30 +51,139 @@ def compatible_keys(key1, key2):
             return False
     return True
 
-def get_jobs(schemas, target_keys):
-    dfs = []
-    for schema_name, schema in schemas.items():
-        df = schema.schema.jobs.fetch(format='frame').reset_index()
-        df['key'] = df['key'].apply(rec_to_dict)
-        df['schema'] = schema
-        dfs += [df]
-    dfs = pd.concat(dfs)
-    dfs['key_summary'] = dfs['key'].apply(lambda key : '-'.join([str(v) for v in key.values()]))
-    target = np.zeros(len(dfs), dtype=bool)
-    for target_key in target_keys:
-        target = target | dfs['key'].apply(lambda key : compatible_keys(key, target_key))
-    return dfs.loc[target]
+def match_keys(keys, target_keys):
+    '''
+    Vectorized `compatible_keys` between every key and every target key.
+    Keys are grouped by the set of fields they define and each pair of groups
+    is matched with a join on their overlapping fields.
+    Returns a frame of (index, target) positions of the compatible pairs.
+    '''
+    keys = pd.DataFrame.from_records(
+        [k if isinstance(k, dict) else {} for k in keys]
+    ).astype(object)
+    targets = pd.DataFrame.from_records(list(target_keys)).astype(object)
+    pairs = [pd.DataFrame({'index': [], 'target': []}, dtype=int)]
+    if keys.empty or targets.empty:
+        return pairs[0]
+    keys['index'], targets['target'] = range(len(keys)), range(len(targets))
+    key_groups = keys.drop(columns='index').notna()
+    target_groups = targets.drop(columns='target').notna()
+    for _, key_group in keys.groupby(key_groups.groupby(list(key_groups)).ngroup()):
+        key_fields = key_group.columns[key_group.notna().all()].drop('index')
+        for _, target_group in targets.groupby(
+            target_groups.groupby(list(target_groups)).ngroup()
+        ):
+            fields = [
+                f for f in target_group.columns[target_group.notna().all()]
+                if f in key_fields
+            ]
+            if not fields:
+                continue
+            pairs.append(
+                key_group[[*fields, 'index']].merge(
+                    target_group[[*fields, 'target']], on=fields
+                )[['index', 'target']]
+            )
+    return pd.concat(pairs, ignore_index=True).drop_duplicates()
+
+def fetch_jobs(schema, table_names=None, status=None):
+    '''
+    Fetch the jobs table of `schema`, restricted on the server by table name
+    and job status when given, without the (large) error stacks.
+    '''
+    jobs = schema.schema.jobs.proj(..., '-error_stack')
+    if table_names is not None:
+        jobs = jobs & [{'table_name': t} for t in table_names]
+    if status is not None:
+        jobs = jobs & [{'status': s} for s in status]
+    df = jobs.fetch(format='frame').reset_index()
+    df['key'] = df['key'].apply(rec_to_dict)
+    df['schema'] = schema
+    df['key_summary'] = df['key'].apply(
+        lambda key : '-'.join([str(v) for v in key.values()])
+    )
+    return df
+
+class JobsSnapshot:
+    '''
+    Jobs tables fetched once and shared by every scan they are matched against.
+    Each schema's table is fetched on first use, and fetched again once it is
+    older than `ttl` seconds (kept for the life of the snapshot if `ttl` is None).
+    '''
+    def __init__(self, schemas=None, ttl=None, table_names=None, status=None):
+        self.schemas = VirtualSchemas([*jobs_schemas, 'stack']) if schemas is None else schemas
+        self.ttl = ttl
+        self.table_names = table_names
+        self.status = status
+        self._tables = {}
+
+    def table(self, schema_name):
+        fetched = self._tables.get(schema_name)
+        if fetched is None or (
+            self.ttl is not None and time.monotonic() - fetched[0] > self.ttl
+        ):
+            fetched = time.monotonic(), fetch_jobs(
+                self.schemas[schema_name], self.table_names, self.status
+            )
+            self._tables[schema_name] = fetched
+        return fetched[1]
+
+    def refresh(self):
+        self._tables.clear()
+
+    def frame(self, schema_names=None):
+        schema_names = self.schemas if schema_names is None else schema_names
+        return pd.concat([self.table(name) for name in schema_names])
+
+    def get_jobs(self, target_keys, schema_names=None):
+        dfs = self.frame(schema_names)
+        target = np.zeros(len(dfs), dtype=bool)
+        target[match_keys(dfs['key'], target_keys)['index'].to_numpy()] = True
+        return dfs.loc[target]
+
+    def split(self, target_keys, owner_keys, schema_names=None):
+        '''
+        Jobs compatible with each of `target_keys`, with the fields of the
+        owner key at the same position added as columns. A job is listed once
+        for every owner it matches, grouped by owner in order of appearance.
+        '''
+        dfs = self.frame(schema_names)
+        owners = pd.DataFrame.from_records(list(owner_keys))
+        owner_ids = owners.groupby(list(owners), sort=False).ngroup().to_numpy()
+        pairs = match_keys(dfs['key'], target_keys)
+        pairs['owner'] = owner_ids[pairs['target'].to_numpy()]
+        pairs = pairs.drop_duplicates(['owner', 'index']).sort_values(
+            ['owner', 'index'], kind='stable'
+        )
+        df = dfs.iloc[pairs['index'].to_numpy()].reset_index(drop=True)
+        for k in owners:
+            df[k] = owners[k].to_numpy()[pairs['target'].to_numpy()]
+        return df
+
+def get_jobs(schemas, target_keys, table_names=None, status=None):
+    return JobsSnapshot(schemas, table_names=table_names, status=status).get_jobs(
+        target_keys
+    )
 
 def restrict_with_jobs_df(jobs_df, index):
     return jobs_df.loc[index, 'schema'].schema.jobs & dict(jobs_df.loc[index, ['table_name', 'key_hash']])
 
+default_errors = (
+    'LostConnectionError: Connection was lost during a transaction.',
+    "OperationalError: (1205, 'Lock wait timeout exceeded; try restarting transaction')",
+)
+
 def delete_errors(
     jobs_df, 
-    errors=(
-            'LostConnectionError: Connection was lost during a transaction.',
-            "OperationalError: (1205, 'Lock wait timeout exceeded; try restarting transaction')",
-        ),
+    errors=default_errors,
+    bulk=False,
+    dry_run=False,
+    chunk_size=1000,
 ):
+    if bulk or dry_run:
+        return bulk_delete_errors(
+            jobs_df, errors=errors, dry_run=dry_run, chunk_size=chunk_size
+        )
     for i, job in jobs_df.iterrows():
         if job['status'] == 'error':
             job_key = {'key_hash':job['key_hash'], 'table_name':job['table_name']}
@@ -69,3 +193,34 @@ def delete_errors(
             else:
                 if job_info['error_message'] in errors:
                     (job['schema'].schema.jobs & job_key).delete()
+
+def bulk_delete_errors(jobs_df, errors=default_errors, dry_run=False, chunk_size=1000):
+    '''
+    Delete the error jobs of `jobs_df` whose message is in `errors` (every error
+    job if `errors == 'all'`) with one `delete_quick` per table and chunk of
+    `chunk_size` jobs. Status and message are checked again on the server, so
+    jobs that changed since `jobs_df` was fetched are left alone.
+    Returns the number of jobs deleted per schema and table, or the number that
+    would be deleted if `dry_run`.
+    '''
+    df = jobs_df[jobs_df['status'] == 'error']
+    if errors != 'all':
+        df = df[df['error_message'].isin(errors)]
+    df = df.drop_duplicates(['schema', 'table_name', 'key_hash'])
+    rec = []
+    for (schema, table_name), table_df in df.groupby(['schema', 'table_name'], sort=False):
+        jobs = schema.schema.jobs & {'table_name': table_name, 'status': 'error'}
+        if errors != 'all':
+            jobs = jobs & [{'error_message': e} for e in errors]
+        n = 0
+        for start in range(0, len(table_df), chunk_size):
+            chunk = jobs & [
+                {'key_hash': h} for h in table_df['key_hash'].iloc[start:start + chunk_size]
+            ]
+            n += len(chunk) if dry_run else chunk.delete_quick(get_count=True)
+        rec.append({'schema': schema.schema.database, 'table_name': table_name, 'deleted': n})
+        logger.info(
+            f"{'Would delete' if dry_run else 'Deleted'} {n} error jobs from "
+            f"{schema.schema.database}.{table_name}"
+        )
+    return pd.DataFrame.from_records(rec, columns=['schema', 'table_name', 'deleted'])
@@ -0,0 +1,85 @@
+import fcntl
+import json
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from decimal import Decimal
+from pathlib import Path
+import numpy as np
+
+
+def to_builtin(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, Decimal):
+        return str(obj)
+    if isinstance(obj, (datetime, Path)):
+        return str(obj)
+    raise TypeError(f"Cannot serialize {type(obj)} in the QC manifest.")
+
+
+def normalize(inputs):
+    # compare inputs the way they are read back from the manifest
+    return json.loads(json.dumps(inputs, default=to_builtin, sort_keys=True))
+
+
+class Manifest:
+    """
+    Record of the QC steps rendered into a scan's output folder, kept as
+    `manifest.json` next to the figures. Each step stores the fingerprint of
+    its upstream data and rendering options, the file it produced and the
+    metrics of its data, so that skipped steps still report them.
+    Steps of a scan may be saved concurrently (e.g. by the per-step jobs of
+    `PipelineQcStepDone`): `update` re-reads the file and merges its step
+    under a lock, and writes it through a temporary file of its own.
+    """
+
+    filename = "manifest.json"
+
+    def __init__(self, folder):
+        self.path = Path(folder) / self.filename
+        self.steps = self.read()
+
+    def is_fresh(self, step, inputs):
+        entry = self.steps.get(step)
+        return (
+            entry is not None
+            and entry["inputs"] == normalize(inputs)
+            and Path(entry["file"]).is_file()
+        )
+
+    def file(self, step):
+        return self.steps[step]["file"]
+
+    def metrics(self, step):
+        # entries written before metrics were stored have none
+        return self.steps[step].get("metrics", {})
+
+    def read(self):
+        return json.loads(self.path.read_text()) if self.path.is_file() else {}
+
+    @contextmanager
+    def lock(self):
+        with open(self.path.with_suffix(".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def update(self, step, inputs, file, metrics=None):
+        entry = dict(
+            inputs=normalize(inputs),
+            file=str(file),
+            metrics=normalize(metrics or {}),
+            updated=datetime.now().isoformat(),
+        )
+        with self.lock():
+            # keep the steps other writers saved since this manifest was read
+            self.steps = {**self.read(), step: entry}
+            self.save()
+
+    def save(self):
+        tmp = self.path.with_name(f".{self.filename}.{uuid.uuid4().hex}")
+        tmp.write_text(json.dumps(self.steps, indent=2, sort_keys=True))
+        tmp.replace(self.path)
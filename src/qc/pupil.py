@@ -1,8 +1,59 @@
 import pandas as pd
 import numpy as np
 import cv2
+import datajoint as dj
 from matplotlib import pyplot as plt
-from . import virtual as V, utils
+from . import virtual as V, utils, instrument
+from .errors import MissingError
+
+
+class FrameReader:
+    """
+    Grayscale, cropped frames of a video, decoded in one sorted forward pass.
+    Requested frames are decoded by `load` (grabbing past the frames in between
+    instead of seeking to each one) and served from memory afterwards.
+    """
+
+    def __init__(self, vid, crop=None):
+        self.vid = vid
+        self.crop = crop
+        self.frames = {}
+
+    def load(self, frame_idx):
+        frame_idx = sorted(set(int(j) for j in frame_idx) - set(self.frames))
+        if not frame_idx:
+            return
+        self.vid.set(cv2.CAP_PROP_POS_FRAMES, frame_idx[0])
+        pos = frame_idx[0]
+        for j in frame_idx:
+            while pos < j:
+                if not self.vid.grab():
+                    raise ValueError(f"Video ended before frame {j}")
+                pos += 1
+            ret, frame = self.vid.read()
+            pos += 1
+            if not ret:
+                raise ValueError(f"Failed to read frame {j}")
+            frame = frame.mean(-1)
+            if self.crop is not None:
+                crop = self.crop
+                frame = frame[crop[2] : crop[3], crop[0] : crop[1]]
+            self.frames[j] = frame
+
+    def __getitem__(self, j):
+        if j not in self.frames:
+            self.load([j])
+        return self.frames[j]
+
+
+def downsample_frame(frame, ax):
+    """Shrink `frame` to the pixel size of `ax` at its figure's dpi, if larger."""
+    bbox = ax.get_window_extent()
+    scale = min(bbox.width / frame.shape[1], bbox.height / frame.shape[0])
+    if scale >= 1:
+        return frame
+    size = (max(int(frame.shape[1] * scale), 1), max(int(frame.shape[0] * scale), 1))
+    return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
 
 
 def plot_pupil_fit(
@@ -16,31 +67,37 @@ def plot_pupil_fit(
     vmax=None,
     axes=None,
     sample_idx=None,
+    downsample=False,
 ):
 
     if sample_idx is None:
         sample_idx = np.linspace(0, len(x) - 1, 50).astype(int)
     if axes is None:
         _, axes = plt.subplots(10, 10, figsize=[20, 20])
+    # `vid` is either a cv2.VideoCapture or frames already cropped, indexed by
+    # frame number (a FrameReader or a dict)
+    frames = FrameReader(vid, crop) if isinstance(vid, cv2.VideoCapture) else vid
+    if isinstance(frames, FrameReader):
+        frames.load(sample_idx)
+    if isinstance(points, pd.DataFrame):
+        points = np.stack(points.x).T, np.stack(points.y).T
     for i, j in enumerate(sample_idx):
-        vid.set(1, j)
-        ret, pupil_frame = vid.read()
-        pupil_frame = pupil_frame.mean(-1)
-        if crop is not None:
-            pupil_frame = pupil_frame[crop[2] : crop[3], crop[0] : crop[1]]
+        pupil_frame = frames[int(j)]
         col = i % 10
         track_row = i // 10 * 2
         fit_row = i // 10 * 2 + 1
+        # keep the original pixel coordinates for the points and circle overlays
+        extent = (-0.5, pupil_frame.shape[1] - 0.5, pupil_frame.shape[0] - 0.5, -0.5)
+        if downsample:
+            pupil_frame = downsample_frame(pupil_frame, axes[track_row, col])
         plt.sca(axes[track_row, col])
         _vmin = vmin or pupil_frame.min()
         _vmax = vmax or pupil_frame.max()
-        plt.imshow(pupil_frame, vmin=_vmin, vmax=_vmax, cmap="gray")
+        plt.imshow(pupil_frame, vmin=_vmin, vmax=_vmax, cmap="gray", extent=extent)
         if points is not None:
-            points_x = np.stack(points.x)[:, j]
-            points_y = np.stack(points.y)[:, j]
-            plt.scatter(points_x, points_y, color="r", s=1)
+            plt.scatter(points[0][j], points[1][j], color="r", s=1)
         plt.sca(axes[fit_row, col])
-        plt.imshow(pupil_frame, vmin=_vmin, vmax=_vmax, cmap="gray")
+        plt.imshow(pupil_frame, vmin=_vmin, vmax=_vmax, cmap="gray", extent=extent)
         if x is not np.nan:
             circle = plt.Circle(
                 (x[j], y[j]), r[j], fill=False, edgecolor="r", linestyle="--"
@@ -50,60 +107,158 @@ def plot_pupil_fit(
         ax.set_axis_off()
 
 
-def pupil_qc(key, seed=0):
-    rng = np.random.default_rng(seed)
-    # fetch data
-    crop = (V.pupil.Tracking.Deeplabcut & key).fetch1(
-        "cropped_x0", "cropped_x1", "cropped_y0", "cropped_y1"
+def pupil_fit_fingerprint(key):
+    """Row counts and server-side checksums of the pupil fits of `key`."""
+    return dict(
+        circle=(
+            dj.U().aggr(
+                V.pupil.FittedPupil.Circle & key,
+                n="count(*)",
+                center_crc="sum(crc32(center))",
+                radius_crc="sum(crc32(radius))",
+            )
+        ).fetch1(),
+        points=(
+            dj.U().aggr(
+                V.pupil.FittedPupil.EyePoints & key,
+                n="count(*)",
+                x_crc="sum(crc32(x))",
+                y_crc="sum(crc32(y))",
+            )
+        ).fetch1(),
+    )
+
+
+def pupil_fingerprint(key, video_path=None):
+    """
+    `pupil_fit_fingerprint` and the tracking crop of `key`, plus the size and
+    modification time of its behavior video (at `video_path`, if resolved).
+    """
+    video = (video_path or utils.get_beh_h5_filepath(key)).stat()
+    return dict(
+        **pupil_fit_fingerprint(key),
+        crop=(V.pupil.Tracking.Deeplabcut & key).fetch1(
+            "cropped_x0", "cropped_x1", "cropped_y0", "cropped_y1"
+        ),
+        video=dict(size=video.st_size, mtime=video.st_mtime),
     )
-    pupil_df = pd.DataFrame(
-        (V.pupil.FittedPupil().Circle & key).fetch(
-            "center", "radius", "KEY", as_dict=True, order_by="frame_id ASC"
-        )
+
+
+def load_pupil_fit(key):
+    """
+    Per-frame pupil fits of a scan as contiguous arrays, ordered by frame:
+    x, y, r: pupil center and radius, NaN where the fit failed
+    nans: mask of the frames with any NaN in x, y or r
+    points_x, points_y: (n_frames, n_points) tracked eye point coordinates
+    labels: eye point labels, in the column order of points_x/points_y
+    """
+    center, radius = (V.pupil.FittedPupil.Circle & key).fetch(
+        "center", "radius", order_by="frame_id ASC"
     )
-    pupil_x = np.array(
-        [coor[0] if coor is not None else np.nan for coor in pupil_df.center.to_numpy()]
+    if not len(center):
+        raise MissingError(f"No FittedPupil for {key}")
+    x = np.full(len(center), np.nan)
+    y = np.full(len(center), np.nan)
+    valid = np.fromiter((c is not None for c in center), bool, len(center))
+    if valid.any():
+        xy = np.stack(center[valid]).reshape(valid.sum(), -1)
+        x[valid], y[valid] = xy[:, 0], xy[:, 1]
+    r = np.asarray(radius, dtype=float)
+    points_x, points_y, labels = (V.pupil.FittedPupil.EyePoints & key).fetch(
+        "x", "y", "label", order_by="label"
     )
-    pupil_y = np.array(
-        [coor[1] if coor is not None else np.nan for coor in pupil_df.center.to_numpy()]
+    return dict(
+        x=x,
+        y=y,
+        r=r,
+        nans=np.isnan(x) | np.isnan(y) | np.isnan(r),
+        points_x=np.ascontiguousarray(
+            np.stack(points_x).reshape(len(labels), -1).astype(float).T
+        ),
+        points_y=np.ascontiguousarray(
+            np.stack(points_y).reshape(len(labels), -1).astype(float).T
+        ),
+        labels=labels,
     )
-    pupil_r = pupil_df.radius.to_numpy()
-    nans = np.isnan(pupil_x) | np.isnan(pupil_y) | np.isnan(pupil_r)
-    eye_points = pd.DataFrame(
-        (V.pupil.FittedPupil.EyePoints() & key).fetch("x", "y", "label", as_dict=True)
+
+
+def pupil_metrics(data):
+    """
+    pupil_nan_frac: fraction of frames without a pupil fit
+    pupil_longest_nan_run: longest run of consecutive frames without a fit
+    """
+    return dict(
+        pupil_nan_frac=float(data["nans"].mean()) if len(data["nans"]) else None,
+        pupil_longest_nan_run=utils.longest_run(data["nans"]),
+    )
+
+
+def fetch_pupil_qc(key, seed=0, frames=True, video_path=None):
+    """
+    Data of the pupil QC figure, with the frames decoded from the behavior
+    video (at `video_path`, if resolved); without `frames`, only the fits.
+    """
+    rng = np.random.default_rng(seed)
+    # fetch data
+    fit = load_pupil_fit(key)
+    assert len(fit["labels"]) == 16
+    if not frames:
+        return fit
+    crop = (V.pupil.Tracking.Deeplabcut & key).fetch1(
+        "cropped_x0", "cropped_x1", "cropped_y0", "cropped_y1"
     )
-    assert len(eye_points) == 16
 
     # load eye video
-    video_path = utils.get_beh_h5_filepath(key)
+    video_path = video_path or utils.get_beh_h5_filepath(key)
     assert video_path.is_file()
-    pupil_video = cv2.VideoCapture(str(video_path))
-    assert pupil_video.get(cv2.CAP_PROP_FRAME_COUNT) == len(pupil_x)
+    sample_idx = np.linspace(0, len(fit["x"]) - 1, 50).astype(int)
+    nan_idx = np.nonzero(fit["nans"])[0]
+    if len(nan_idx) > 50:
+        nan_idx = np.sort(rng.choice(nan_idx, 50, replace=False))
+    with instrument.phase("decode"):
+        pupil_video = cv2.VideoCapture(str(video_path))
+        assert pupil_video.get(cv2.CAP_PROP_FRAME_COUNT) == len(fit["x"])
+        # decode the frames of both figures in a single pass over the video
+        frames = FrameReader(pupil_video, crop)
+        frames.load([*sample_idx, *nan_idx])
+        pupil_video.release()
+    frame_idx = np.array(sorted(frames.frames), dtype=int)
+
+    pupil_key = (V.pupil.FittedPupil & key).fetch1("KEY")
+    return dict(
+        fit,
+        name="pupil_" + utils.dict2str(pupil_key),
+        # scan key title
+        title=f'{key["animal_id"]}-{key["session"]}-{key["scan_idx"]}',
+        sample_idx=sample_idx,
+        nan_idx=nan_idx,
+        frame_idx=frame_idx,
+        frames=np.stack([frames[j] for j in frame_idx]).astype(np.float32),
+    )
 
-    # scan key title
-    scan_key = f'{key["animal_id"]}-{key["session"]}-{key["scan_idx"]}'
+
+def render_pupil_qc(data, dpi=None):
+    pupil_x, pupil_y, pupil_r, nans = data["x"], data["y"], data["r"], data["nans"]
+    eye_points = data["points_x"], data["points_y"]
+    frames = dict(zip(data["frame_idx"].tolist(), data["frames"]))
+    scan_key = data["title"]
 
     # figure layout
-    fig = plt.figure(figsize=(20, 45))
+    fig = plt.figure(figsize=(20, 45), dpi=dpi)
     subfigs = fig.subfigures(3, 1, hspace=0.025, height_ratios=[1, 4, 4])
 
     # [Figure 1] check traces
     axes = subfigs[0].subplots(3, 1, sharex=True)
-    plt.sca(axes[0])
-    plt.plot(pupil_x, "k", linewidth=0.5)
-    plt.ylabel("pupil center x")
-    twinx = axes[0].twinx()
-    twinx.plot(nans, "r", linewidth=0.5, alpha=0.2)
-    plt.sca(axes[1])
-    plt.plot(pupil_y, "k", linewidth=0.5)
-    plt.ylabel("pupil center y")
-    twinx = axes[1].twinx()
-    twinx.plot(nans, "r", linewidth=0.5, alpha=0.2)
-    plt.sca(axes[2])
-    plt.plot(pupil_r, "k", linewidth=0.5)
-    plt.ylabel("pupil radius")
-    twinx = axes[2].twinx()
-    twinx.plot(nans, "r", linewidth=0.5, alpha=0.2)
+    # traces are decimated to the axes width, keeping spikes and NaN gaps
+    n_bins = utils.pixel_width(axes[0])
+    for ax, trace, label in zip(
+        axes, (pupil_x, pupil_y, pupil_r), ("pupil center x", "pupil center y", "pupil radius")
+    ):
+        plt.sca(ax)
+        plt.plot(*utils.decimate(trace, n_bins=n_bins), "k", linewidth=0.5)
+        plt.ylabel(label)
+        twinx = ax.twinx()
+        twinx.plot(*utils.decimate(nans, n_bins=n_bins), "r", linewidth=0.5, alpha=0.2)
     subfigs[0].suptitle(
         f"{scan_key}\n{nans.sum()}/{len(pupil_r)} ({nans.sum()/len(pupil_r)*100:.2f}%) nans in total"
     )
@@ -111,25 +266,32 @@ def pupil_qc(key, seed=0):
     # [Figure 2] uniformly sample frames and check tracking and fitting
     axes = subfigs[1].subplots(10, 10)
     plot_pupil_fit(
-        pupil_x, pupil_y, pupil_r, pupil_video, crop=crop, points=eye_points, axes=axes
+        pupil_x,
+        pupil_y,
+        pupil_r,
+        frames,
+        points=eye_points,
+        axes=axes,
+        sample_idx=data["sample_idx"],
+        downsample=dpi is not None,
     )
     subfigs[1].suptitle(scan_key + "uniformly sampled over time", y=0.9)
 
     # [Figure 3] check examples of tracking/fitting failures
     axes = subfigs[2].subplots(10, 10)
-    nan_idx = np.nonzero(nans)[0]
-    if len(nan_idx) > 50:
-        nan_idx = sorted(rng.choice(nan_idx, 50, replace=False))
     plot_pupil_fit(
         pupil_x,
         pupil_y,
         pupil_r,
-        pupil_video,
-        crop=crop,
+        frames,
         points=eye_points,
         axes=axes,
-        sample_idx=nan_idx,
+        sample_idx=data["nan_idx"],
+        downsample=dpi is not None,
     )
     subfigs[2].suptitle(scan_key + "nan examples", y=0.9)
-    pupil_key = (V.pupil.FittedPupil & key).fetch1('KEY')
-    return 'pupil_' + utils.dict2str(pupil_key), plt.gcf()
+    return data["name"], fig
+
+
+def pupil_qc(key, seed=0, dpi=None):
+    return render_pupil_qc(fetch_pupil_qc(key, seed=seed), dpi=dpi)
@@ -0,0 +1,218 @@
+"""
+One indexed report per batch instead of a folder of figures per scan.
+
+`Batch.run_qc(report="qc.html")` streams a PNG of every figure into the
+report as it is made; `close` then writes either a static HTML page (small
+thumbnails loaded lazily, each linking to its full resolution figure,
+columns sortable by clicking their header) or, for a ".pdf" path, a
+multi-page PDF with a page per figure at a readable resolution, its title
+linking to the full resolution figure. Figures skipped as up to date are
+listed with their link and the metrics stored in their manifest, without a
+thumbnail. Rows or pages are ordered by `sort_by`, e.g. a QC metric such as
+"pupil_nan_frac"; the metrics of every step of a scan apply to all of its
+figures.
+"""
+import html
+import io
+import os
+import shutil
+import tempfile
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from matplotlib import pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
+from .logging import logger
+from .status import SCAN_ATTRS
+
+RECORD_FIELDS = ("step", "status", "file", "error")
+
+SORT_SCRIPT = """
+<script>
+document.querySelectorAll("th").forEach((th, col) => th.addEventListener("click", () => {
+  const body = th.closest("table").tBodies[0];
+  const asc = th.dataset.asc !== "true";
+  th.dataset.asc = asc;
+  const value = row => {
+    const text = row.cells[col].dataset.value ?? row.cells[col].textContent;
+    return text === "" || isNaN(text) ? text : Number(text);
+  };
+  [...body.rows]
+    .sort((a, b) => (value(a) > value(b) ? 1 : value(a) < value(b) ? -1 : 0) * (asc ? 1 : -1))
+    .forEach(row => body.appendChild(row));
+}));
+</script>
+"""
+
+
+def thumbnail(fig, dpi=30):
+    """PNG bytes of `fig` at `dpi`."""
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", dpi=dpi)
+    return buffer.getvalue()
+
+
+class Report:
+    """
+    Report at `path` (".html" or ".pdf"), built from (record, PNG) pairs
+    given to `add`, with the figures rendered at `dpi` (by default 30 for
+    HTML thumbnails, 100 for PDF pages). PNGs are kept on disk, written once
+    `flush_every` of them or `max_pending_bytes` are pending, so memory does
+    not grow with the batch; only the records are held until `close`.
+    """
+
+    def __init__(
+        self,
+        path,
+        sort_by=None,
+        ascending=True,
+        dpi=None,
+        flush_every=50,
+        max_pending_bytes=100e6,
+    ):
+        self.path = Path(path)
+        assert self.path.suffix in (".html", ".pdf"), "Report must be .html or .pdf"
+        self.sort_by = sort_by
+        self.ascending = ascending
+        self.dpi = dpi or (30 if self.path.suffix == ".html" else 100)
+        self.flush_every = flush_every
+        self.max_pending_bytes = max_pending_bytes
+        if self.path.suffix == ".html":
+            self.thumbs = self.path.with_name(self.path.stem + "_thumbs")
+        else:
+            self.thumbs = Path(tempfile.mkdtemp(prefix="qc_report_"))
+        self.thumbs.mkdir(parents=True, exist_ok=True)
+        self.records = []
+        self.metrics = {}
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, rec, png=None):
+        """Add a record of `Scan.iter_qc` and the PNG bytes of its figure, if any."""
+        scan = tuple(rec[k] for k in SCAN_ATTRS)
+        # fields other than key and status are the metrics of the step
+        self.metrics.setdefault(scan, {}).update(
+            (k, v) for k, v in rec.items() if k not in (*SCAN_ATTRS, *RECORD_FIELDS)
+        )
+        rec = {
+            **{k: rec[k] for k in SCAN_ATTRS},
+            **{k: rec.get(k) for k in RECORD_FIELDS},
+            "scan": scan,
+        }
+        rec["thumbnail"] = None
+        if png is not None:
+            rec["thumbnail"] = self.thumbs / f"{len(self.records):06d}.png"
+            self._pending.append((rec["thumbnail"], png))
+        self.records.append(rec)
+        if (
+            len(self._pending) >= self.flush_every
+            or sum(len(png) for _, png in self._pending) >= self.max_pending_bytes
+        ):
+            self.flush()
+
+    def flush(self):
+        """Write the pending thumbnails."""
+        for path, png in self._pending:
+            path.write_bytes(png)
+        self._pending = []
+
+    def frame(self):
+        """A row per figure with the metrics of its scan, in report order."""
+        rows = [
+            {**rec, **self.metrics[rec["scan"]]}
+            for rec in self.records
+        ]
+        df = pd.DataFrame.from_records(rows).drop(columns="scan", errors="ignore")
+        if self.sort_by is not None and self.sort_by in df:
+            df = df.sort_values(self.sort_by, ascending=self.ascending, kind="stable")
+        return df
+
+    def close(self):
+        self.flush()
+        df = self.frame()
+        if self.path.suffix == ".html":
+            self.write_html(df)
+        else:
+            self.write_pdf(df)
+            shutil.rmtree(self.thumbs, ignore_errors=True)
+        logger.info(f"Wrote QC report of {len(df)} figures to {self.path}")
+        return self.path
+
+    def _link(self, file):
+        try:
+            return os.path.relpath(file, self.path.parent)
+        except ValueError:
+            return str(file)
+
+    def write_html(self, df):
+        columns = [c for c in df if c not in ("file", "thumbnail", "error")]
+        head = "".join(f"<th>{html.escape(str(c))}</th>" for c in [*columns, "figure"])
+        rows = []
+        for rec in df.to_dict("records"):
+            cells = [
+                f'<td data-value="{html.escape(str(_value(rec[c])))}">{html.escape(_text(rec[c]))}</td>'
+                for c in columns
+            ]
+            if isinstance(rec["thumbnail"], Path) and isinstance(rec["file"], str):
+                figure = (
+                    f'<a href="{html.escape(self._link(rec["file"]))}">'
+                    f'<img loading="lazy" src="{html.escape(self._link(rec["thumbnail"]))}"></a>'
+                )
+            elif isinstance(rec["file"], str):
+                figure = f'<a href="{html.escape(self._link(rec["file"]))}">figure</a>'
+            else:
+                figure = html.escape(_text(rec["error"]))
+            rows.append(f"<tr>{''.join(cells)}<td>{figure}</td></tr>")
+        self.path.write_text(
+            "<!DOCTYPE html><html><head><meta charset='utf-8'><title>QC report</title>"
+            "<style>table{border-collapse:collapse}td,th{border:1px solid #ccc;"
+            "padding:2px 6px}th{cursor:pointer}img{max-height:240px}</style></head>"
+            f"<body><table><thead><tr>{head}</tr></thead><tbody>{''.join(rows)}"
+            f"</tbody></table>{SORT_SCRIPT}</body></html>"
+        )
+
+    def write_pdf(self, df, header=0.4):
+        keys = [c for c in df if c not in ("file", "thumbnail", "error", "status")]
+        with PdfPages(self.path) as pdf:
+            for rec in df.to_dict("records"):
+                if isinstance(rec["thumbnail"], Path):
+                    image = plt.imread(rec["thumbnail"])
+                    height, width = image.shape[:2]
+                elif isinstance(rec["file"], str):
+                    # not rendered in this run (e.g. skipped as up to date):
+                    # only the title, linking to the figure
+                    image, height, width = None, 0, 8 * self.dpi
+                else:
+                    continue
+                # a page the size of the figure, drawn pixel for pixel below a
+                # `header` inch title that links to the full resolution figure
+                fig = plt.figure(
+                    figsize=(width / self.dpi, height / self.dpi + header), dpi=self.dpi
+                )
+                if image is not None:
+                    fig.figimage(image, 0, 0)
+                fig.text(
+                    0.01,
+                    1 - header / 2 / fig.get_figheight(),
+                    ", ".join(f"{k}={_text(rec[k])}" for k in keys),
+                    fontsize=8,
+                    va="center",
+                    color="tab:blue",
+                    url=Path(rec["file"]).resolve().as_uri(),
+                )
+                pdf.savefig(fig, dpi=self.dpi)
+                plt.close(fig)
+
+
+def _value(value):
+    return "" if value is None or (isinstance(value, float) and np.isnan(value)) else value
+
+
+def _text(value):
+    value = _value(value)
+    return f"{value:.4g}" if isinstance(value, float) else str(value)
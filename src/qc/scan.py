@@ -1,19 +1,47 @@
-from . import (
-    virtual as V,
-    pupil,
-    treadmill,
-    utils,
-    jobs,
-    stack,
-    logging as logger,
-    MissingError,
-)
+from . import virtual as V, pupil, treadmill, utils, jobs, stack, instrument, cache
+from .errors import MissingError
+from .logging import logger
+from .manifest import Manifest
 from dataclasses import dataclass, asdict
+from functools import wraps
 from pathlib import Path
 import pandas as pd
 import datajoint as dj
 
 
+def memoized(func):
+    """Property computed once per Scan instance, until `Scan.invalidate`."""
+    name = func.__name__
+
+    @property
+    @wraps(func)
+    def wrapper(self):
+        stats = self._cache_stats.setdefault(name, {"hits": 0, "misses": 0})
+        if name in self._cache:
+            stats["hits"] += 1
+        else:
+            stats["misses"] += 1
+            self._cache[name] = func(self)
+        return self._cache[name]
+
+    return wrapper
+
+
+# render phase of each QC step, from the data of its fetch phase
+renderers = dict(
+    treadmill=treadmill.render_treadmill_qc,
+    pupil=pupil.render_pupil_qc,
+    rot=stack.render_rot_qc,
+)
+
+# numeric summary of each QC step, from the data of its fetch phase
+measures = dict(
+    treadmill=treadmill.treadmill_metrics,
+    pupil=pupil.pupil_metrics,
+    rot=stack.rot_metrics,
+)
+
+
 @dataclass
 class Scan(dict):
     animal_id: int
@@ -24,12 +52,32 @@ class Scan(dict):
     spike_method: int = 6
     registration_method: int = 5
 
+    def __post_init__(self):
+        self._cache = {}
+        self._cache_stats = {}
+
     @property
     def key(self) -> dict:
         return {k: v for k, v in asdict(self).items() if v is not None}
 
-    ## Useful queries
+    ## Query cache
+    def preload(self, **values):
+        """Set memoized properties to values resolved in bulk, e.g. by a Batch."""
+        self._cache.update(values)
+
+    def invalidate(self, *names):
+        """Drop the cached values of `names`, or of every memoized property."""
+        for name in names or list(self._cache):
+            self._cache.pop(name, None)
+
     @property
+    def cache_info(self):
+        return pd.DataFrame.from_dict(
+            self._cache_stats, orient="index", columns=["hits", "misses"]
+        )
+
+    ## Useful queries
+    @memoized
     def pipe(self):
         return utils.get_pipe(self.key)
 
@@ -37,11 +85,11 @@ class Scan(dict):
     def scan_done(self) -> bool:
         return bool(len(self.pipe.ScanDone & self.key))
 
-    @property
+    @memoized
     def stack(self):
         return stack.find_stack(self.key)
 
-    @property
+    @memoized
     def stack_reg_task(self):
         # check if CorrectionChannel is inserted for every scan field
         assert (
@@ -79,9 +127,13 @@ class Scan(dict):
     def stack_reg_field(self):
         return V.stack.Registration & self.stack_reg_task
 
+    @memoized
+    def n_reg_task(self):
+        return len(V.stack.RegistrationTask & self.stack_reg_task)
+
     @property
     def stack_reg_done(self):
-        if len(V.stack.RegistrationTask & self.stack_reg_task) != self.nfields:
+        if self.n_reg_task != self.nfields:
             return "not scheduled"
         return len(self.stack_reg_field) == self.nfields
 
@@ -89,9 +141,13 @@ class Scan(dict):
     def stack_rot_field(self):
         return V.stack.RegistrationOverTime & self.stack_reg_task
 
+    @memoized
+    def n_rot_task(self):
+        return len(V.stack.RegistrationOverTimeTask & self.stack_reg_task)
+
     @property
     def stack_rot_done(self):
-        if len(V.stack.RegistrationOverTimeTask & self.stack_reg_task) != self.nfields:
+        if self.n_rot_task != self.nfields:
             return "not scheduled"
         return len(self.stack_rot_field) == self.nfields
 
@@ -99,11 +155,11 @@ class Scan(dict):
     def fields(self):
         return self.pipe.ScanInfo.Field & self.key
 
-    @property
+    @memoized
     def nfields(self):
         return len(self.fields)
 
-    @property
+    @memoized
     def beh_h5_filepath(self):
         return utils.get_beh_h5_filepath(self.key)
 
@@ -155,20 +211,23 @@ class Scan(dict):
 
     @property
     def jobs_df(self):
-        return jobs.get_jobs(
-            jobs.jobs_schemas,
-            [
-                self.key,
-            ],
-        )
+        return self.get_jobs_df()
+
+    def get_jobs_df(self, snapshot=None):
+        snapshot = snapshot or jobs.JobsSnapshot()
+        return snapshot.get_jobs([self.key], schema_names=list(jobs.jobs_schemas))
 
     @property
     def stack_jobs_df(self):
-        return jobs.get_jobs(
-            {"stack": V.stack}, [self.stack, *self.stack_reg_task.fetch("KEY")]
+        return self.get_stack_jobs_df()
+
+    def get_stack_jobs_df(self, snapshot=None):
+        snapshot = snapshot or jobs.JobsSnapshot({"stack": V.stack})
+        return snapshot.get_jobs(
+            [self.stack, *self.stack_reg_task.fetch("KEY")], schema_names=["stack"]
         )
 
-    def delete_errors(self, errors=None):
+    def delete_errors(self, errors=None, snapshot=None, bulk=False, dry_run=False):
         if errors is None:
             errors = (
                 "LostConnectionError: Connection was lost during a transaction.",
@@ -177,9 +236,12 @@ class Scan(dict):
                     " restarting transaction')"
                 ),
             )
-        jobs.delete_errors(self.jobs_df, errors=errors)
+        snapshot = snapshot or jobs.JobsSnapshot(status=["error"])
+        return jobs.delete_errors(
+            self.get_jobs_df(snapshot), errors=errors, bulk=bulk, dry_run=dry_run
+        )
 
-    def delete_stack_errors(self, errors=None):
+    def delete_stack_errors(self, errors=None, snapshot=None, bulk=False, dry_run=False):
         if errors is None:
             errors = (
                 "LostConnectionError: Connection was lost during a transaction.",
@@ -188,7 +250,10 @@ class Scan(dict):
                     " restarting transaction')"
                 ),
             )
-        jobs.delete_errors(self.stack_jobs_df, errors=errors)
+        snapshot = snapshot or jobs.JobsSnapshot({"stack": V.stack}, status=["error"])
+        return jobs.delete_errors(
+            self.get_stack_jobs_df(snapshot), errors=errors, bulk=bulk, dry_run=dry_run
+        )
 
     @property
     def jobs_progress(self):
@@ -197,7 +262,7 @@ class Scan(dict):
             print(t & self.key)
 
     def fill_registration_task(self, force=False):
-        if len(V.stack.RegistrationTask & self.stack_reg_task) == self.nfields:
+        if self.n_reg_task == self.nfields:
             print("Registration task already scheduled.")
             return
         if not force:
@@ -207,10 +272,11 @@ class Scan(dict):
         V.stack.RegistrationTask.insert(
             self.stack_reg_task, ignore_extra_fields=True, skip_duplicates=True
         )
+        self.invalidate("n_reg_task")
         print("Registration task inserted.")
 
     def fill_rot_task(self, force=False):
-        if len(V.stack.RegistrationOverTimeTask & self.stack_reg_task) == self.nfields:
+        if self.n_rot_task == self.nfields:
             print("RegistrationOverTime task already scheduled.")
             return
         if not force:
@@ -223,18 +289,88 @@ class Scan(dict):
         V.stack.RegistrationOverTimeTask.insert(
             self.stack_reg_task, ignore_extra_fields=True, skip_duplicates=True
         )
+        self.invalidate("n_rot_task")
         print("RegistrationOverTime task inserted.")
 
     ## Quality Control
-    def treadmill_qc(self):
-        return treadmill.treadmill_qc(self.key)
+    def qc_fingerprint(self, step):
+        """Fingerprint of the upstream data of `step`, from the cache when offline."""
+        data_cache = cache.active()
+        if data_cache is not None and not data_cache.validate:
+            fingerprint = data_cache.fingerprint(step, self.key)
+            if fingerprint is not None:
+                return fingerprint
+        return getattr(self, f"{step}_fingerprint")()
+
+    def cached_fetch(self, name, step, fetch, fingerprint=None):
+        """
+        `fetch()`, read through the active cache (see `qc.cache`) under `name`
+        and validated against the fingerprint of `step`, if not given.
+        """
+        data_cache = cache.active()
+        if data_cache is None:
+            return fetch()
+        if fingerprint is None and data_cache.validate:
+            fingerprint = self.qc_fingerprint(step)
+        data = data_cache.get(name, self.key, fingerprint)
+        if data is None:
+            data = fetch()
+            if fingerprint is None:
+                fingerprint = self.qc_fingerprint(step)
+            data_cache.put(name, self.key, data, fingerprint)
+        return data
+
+    def fetch_treadmill_qc(self, fingerprint=None):
+        return self.cached_fetch(
+            "treadmill", "treadmill", lambda: treadmill.fetch_treadmill_qc(self.key), fingerprint
+        )
 
-    def pupil_qc(self):
-        return pupil.pupil_qc(self.key)
+    def fetch_pupil_qc(self, frames=True, fingerprint=None):
+        # the fits alone do not depend on the video, see `pupil_fit_fingerprint`
+        return self.cached_fetch(
+            "pupil" if frames else "pupil_fit",
+            "pupil" if frames else "pupil_fit",
+            lambda: pupil.fetch_pupil_qc(
+                self.key, frames=frames, video_path=self.beh_h5_filepath if frames else None
+            ),
+            fingerprint,
+        )
+
+    def fetch_rot_qc(self, fingerprint=None):
+        def fetch():
+            if self.stack_rot_done is True:
+                return stack.fetch_rot_qc(
+                    self.stack_rot_field.fetch(format="frame").reset_index()
+                )
+            else:
+                raise MissingError("RegistrationOverTime not populated.")
+
+        return self.cached_fetch("rot", "rot", fetch, fingerprint)
+
+    def render_qc(self, step, data, dpi=None):
+        return renderers[step](data, dpi=dpi)
+
+    def treadmill_qc(self, dpi=None):
+        return self.render_qc("treadmill", self.fetch_treadmill_qc(), dpi=dpi)
+
+    def pupil_qc(self, dpi=None):
+        return self.render_qc("pupil", self.fetch_pupil_qc(), dpi=dpi)
+
+    def rot_qc(self, dpi=None):
+        return self.render_qc("rot", self.fetch_rot_qc(), dpi=dpi)
 
-    def rot_qc(self):
+    def treadmill_fingerprint(self):
+        return treadmill.treadmill_fingerprint(self.key)
+
+    def pupil_fingerprint(self):
+        return pupil.pupil_fingerprint(self.key, self.beh_h5_filepath)
+
+    def pupil_fit_fingerprint(self):
+        return pupil.pupil_fit_fingerprint(self.key)
+
+    def rot_fingerprint(self):
         if self.stack_rot_done is True:
-            return stack.rot_qc(self.stack_rot_field.fetch(format="frame").reset_index())
+            return stack.rot_fingerprint(self.stack_rot_field)
         else:
             raise MissingError("RegistrationOverTime not populated.")
 
@@ -250,29 +386,166 @@ class Scan(dict):
     # def mask_classification_qc(self):
     #     return mask_classification.mask_classification_qc(self.key)
 
+    def qc_folder(self, filepath=None):
+        # without `filepath`, figures go under the configured output root
+        return Path(filepath or utils.get_output_root()) / utils.dict2str(self.key)
+
+    def prepare_qc(self, step, manifest=None, options=None, force=False, render=True):
+        """
+        Fetch phase of a QC step: the fingerprint of its upstream data and,
+        unless `manifest` shows the step is up to date, the data to render.
+        Without `render`, only the data its metrics need is fetched.
+        Returns a dict with `inputs`, `data` (None if up to date) and `error`.
+        """
+        prepared = dict(inputs=None, data=None, error=None)
+        with instrument.phase("fetch", **self.key, step=step):
+            try:
+                if not render:
+                    # metrics need the pupil fits but none of the video frames
+                    if step == "pupil":
+                        prepared["data"] = self.fetch_pupil_qc(frames=False)
+                    else:
+                        prepared["data"] = getattr(self, f'fetch_{step}_qc')()
+                    return prepared
+                prepared["inputs"] = dict(
+                    fingerprint=self.qc_fingerprint(step), options=options
+                )
+                if force or manifest is None or not manifest.is_fresh(step, prepared["inputs"]):
+                    prepared["data"] = getattr(self, f'fetch_{step}_qc')(
+                        fingerprint=prepared["inputs"]["fingerprint"]
+                    )
+            except Exception as e:
+                prepared["error"] = e
+        return prepared
+
+    def prefetch_qc(
+            self,
+            filepath=None,
+            steps='pupil-treadmill-rot',
+            fmt="pdf",
+            dpi=None,
+            rasterize=False,
+            force=False,
+            render=True,
+        ):
+        """Fetch phase of every step, to be passed to `iter_qc` as `prefetched`."""
+        manifest = Manifest(self.qc_folder(filepath)) if render else None
+        options = dict(fmt=fmt, dpi=dpi, rasterize=rasterize)
+        return {
+            step: self.prepare_qc(step, manifest, options, force, render)
+            for step in steps.split('-')
+        }
+
+    def iter_qc(
+            self,
+            filepath=None,
+            steps='pupil-treadmill-rot',
+            suppress_errors=True,
+            fmt="pdf",
+            dpi=None,
+            rasterize=False,
+            force=False,
+            prefetched=None,
+            render=True,
+        ):
+        """
+        Run the QC steps one at a time, saving each figure as soon as it is made.
+        Yields a (record, fig) pair per step; with `suppress_errors`, a failed
+        step yields its error in the record and no figure.
+        Figures are saved as `fmt`; with `dpi`, they are rendered at that
+        resolution and video frames are downsampled to it before plotting, and
+        `rasterize` embeds image panels of vector formats as rasters.
+        Steps whose upstream fingerprint and options match the folder's manifest
+        are skipped (status "skipped", no figure) unless `force`.
+        `prefetched` is the output of `prefetch_qc` with the same arguments, in
+        which case only the render phase runs here.
+        Records carry the step's metrics, those stored in the manifest when
+        the step is skipped.
+        Without `render`, no figure is made or saved and nothing is written to
+        `filepath`: every step is measured (status "measured") from its data.
+        """
+        filepath = self.qc_folder(filepath)
+        if render:
+            # create folder if not exist
+            filepath.mkdir(parents=True, exist_ok=True)
+        manifest = Manifest(filepath) if render else None
+        options = dict(fmt=fmt, dpi=dpi, rasterize=rasterize)
+        for step in steps.split('-'):
+            rec = {**self.key, "step": step, "status": "done", "file": None, "error": None}
+            try:
+                if prefetched is None:
+                    prepared = self.prepare_qc(step, manifest, options, force, render)
+                else:
+                    prepared = prefetched[step]
+                if prepared["error"] is not None:
+                    raise prepared["error"]
+                if prepared["data"] is None:
+                    rec.update(
+                        status="skipped", file=manifest.file(step), **manifest.metrics(step)
+                    )
+                    yield rec, None
+                    continue
+                metrics = measures[step](prepared["data"])
+                rec.update(metrics)
+                if not render:
+                    rec["status"] = "measured"
+                    yield rec, None
+                    continue
+                with instrument.phase("render", **self.key, step=step):
+                    name, fig = self.render_qc(step, prepared["data"], dpi=dpi)
+                with instrument.phase("save", **self.key, step=step):
+                    file = utils.save_figure(
+                        fig, filepath / name, fmt=fmt, dpi=dpi, rasterize=rasterize
+                    )
+                manifest.update(step, prepared["inputs"], file, metrics)
+            except Exception as e:
+                if not suppress_errors:
+                    raise
+                logger.error(f"Failed to run {step} qc for {self.key}: {e}")
+                rec.update(status="error", error=f"{type(e).__name__}: {e}")
+                yield rec, None
+                continue
+            rec["file"] = str(file)
+            yield rec, fig
+
     def run_qc(
             self, 
-            filepath="/mnt/lab/users/zhuokun/pipeline_qc",
+            filepath=None,
             steps='pupil-treadmill-rot',
             suppress_errors=True,
+            fmt="pdf",
+            dpi=None,
+            rasterize=False,
+            force=False,
         ):
-        # create folder if not exist
-        filepath = Path(filepath) / utils.dict2str(self.key)
-        filepath.mkdir(parents=True, exist_ok=True)
-        figs = []
-        if suppress_errors:
-            for step in steps.split('-'):
-                try:
-                    figs.append(getattr(self, f'{step}_qc')())
-                except Exception as e:
-                    logger.error(f"Failed to run {step} qc for {self.key}: {e}")
-        else:
-            for step in steps.split('-'):
-                figs.append(getattr(self, f'{step}_qc')())
-        # save figs to file as pdfs
-        for name, fig in figs:
-            fig.savefig(filepath / f"{name}.pdf", bbox_inches="tight")
-        return figs
+        return [
+            (Path(rec["file"]).stem, fig)
+            for rec, fig in self.iter_qc(
+                filepath,
+                steps,
+                suppress_errors,
+                fmt=fmt,
+                dpi=dpi,
+                rasterize=rasterize,
+                force=force,
+            )
+            if fig is not None
+        ]
+
+    def qc_metrics(self, steps='pupil-treadmill-rot', suppress_errors=True):
+        """
+        Metrics of the QC steps, without rendering. With `suppress_errors`, the
+        metrics of a failed step are left out.
+        """
+        metrics = {}
+        for rec, _ in self.iter_qc(
+            steps=steps, suppress_errors=suppress_errors, render=False
+        ):
+            metrics.update(
+                (k, v) for k, v in rec.items()
+                if k not in self.key and k not in ("step", "status", "file", "error")
+            )
+        return metrics
 
 
 # %%
@@ -1,6 +1,13 @@
+import argparse
 import datajoint as dj
-from . import virtual as V, scan, batch
-schema = dj.schema('zhuokun_pipeline_qc', create_schema=True)
+import matplotlib
+from matplotlib import pyplot as plt
+from . import virtual as V, scan, batch, utils
+from .errors import MissingError
+from .logging import logger
+# declaring queries the connection, which a background V.warm() may be using
+V.wait()
+schema = dj.schema(utils.get_schema_name(), create_schema=True)
 
 @schema
 class PipelineQcJob(dj.Manual):
@@ -31,7 +38,6 @@ class PipelineQcDone(dj.Computed):
     def make(self, key):
         scan_qc = scan.Scan(**key)
         scan_qc.run_qc(
-            filepath="/mnt/lab/users/zhuokun/pipeline_qc",
             steps='pupil-treadmill-rot',
             suppress_errors=False
         )
@@ -41,3 +47,107 @@ class PipelineQcDone(dj.Computed):
     def current_batch(self):
         keys = (PipelineQcJob - self).fetch('KEY')
         return batch.Batch(keys)
+
+
+
+@schema
+class PipelineQcStep(dj.Lookup):
+    definition = """
+    qc_step: varchar(16)    # step of Scan.iter_qc
+    """
+    contents = [("pupil",), ("treadmill",), ("rot",)]
+
+
+@schema
+class PipelineQcStepDone(dj.Computed):
+    definition = """
+    -> PipelineQcJob
+    -> PipelineQcStep
+    ---
+    qc_status: varchar(16)       # "done", or "skipped" when the figure was up to date
+    qc_file=null: varchar(1024)  # figure of the step
+    """
+
+    @property
+    def key_source(self):
+        return PipelineQcJob * PipelineQcStep
+
+    def make(self, key):
+        scan_key = {k: v for k, v in key.items() if k != "qc_step"}
+        # one step per job, so a failed step leaves the others done
+        ((rec, fig),) = scan.Scan(**scan_key).iter_qc(
+            steps=key["qc_step"], suppress_errors=False
+        )
+        if fig is not None:
+            plt.close(fig)
+        self.insert1({**key, "qc_status": rec["status"], "qc_file": rec["file"]})
+
+
+def populate(*restrictions, max_calls=None, order="random"):
+    """
+    Drain the QC steps of PipelineQcJob with reserved jobs; any number of
+    workers, on any number of hosts, may run this at once. Figures go under
+    `utils.get_output_root()`. Returns the (key, error) of every failed step.
+    """
+    matplotlib.use("Agg")
+    result = PipelineQcStepDone.populate(
+        *restrictions,
+        reserve_jobs=True,
+        suppress_errors=True,
+        order=order,
+        max_calls=max_calls,
+    )
+    return result["error_list"]
+
+@schema
+class PipelineQcMetrics(dj.Computed):
+    definition = """
+    -> PipelineQcJob
+    ---
+    pupil_nan_frac=null         : float     # fraction of frames without a pupil fit
+    pupil_longest_nan_run=null  : int       # longest run of frames without a pupil fit
+    reg_z_range=null            : float     # range of the median-subtracted reg_z (um)
+    reg_z_out_frac=null         : float     # fraction of frames with reg_z beyond +-10 um of the median
+    treadmill_dropout_frac=null : float     # fraction of treadmill samples that are NaN or after a gap
+    treadmill_jump_count=null   : int       # number of treadmill velocity jumps
+    missing_steps=null          : varchar(64)  # steps without upstream data, e.g. "rot"
+    """
+    steps = ("pupil", "treadmill", "rot")
+
+    @property
+    def key_source(self):
+        return PipelineQcJob
+
+    def make(self, key):
+        # a step whose upstream data is missing (e.g. no stack yet) leaves its
+        # metrics null and is listed in missing_steps, see `recompute_missing`;
+        # any other error fails the job, so that it is retried
+        qc_scan = scan.Scan(**key)
+        metrics, missing = {}, []
+        for step in self.steps:
+            try:
+                metrics.update(qc_scan.qc_metrics(steps=step, suppress_errors=False))
+            except MissingError as e:
+                logger.info(f"No {step} metrics for {key}: {e}")
+                missing.append(step)
+        self.insert1({**key, **metrics, "missing_steps": "-".join(missing) or None})
+
+    @property
+    def missing(self):
+        """Rows with steps whose upstream data was missing when computed."""
+        return self & "missing_steps is not null"
+
+    def recompute_missing(self, **kwargs):
+        """Delete the `missing` rows and populate them again; `kwargs` go to populate."""
+        self.missing.delete_quick()
+        return self.populate(**kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a PipelineQcStepDone worker.")
+    parser.add_argument("--steps", nargs="+", help="restrict to these steps")
+    parser.add_argument("--max-calls", type=int)
+    args = parser.parse_args()
+    restrictions = [[{"qc_step": step} for step in args.steps]] if args.steps else []
+    errors = populate(*restrictions, max_calls=args.max_calls)
+    print(f"{len(errors)} steps failed")
@@ -2,6 +2,7 @@ from . import utils
 from .errors import MissingError
 from .logging import logger
 import qc.virtual as V
+import datajoint as dj
 import pandas as pd
 import numpy as np
 from matplotlib import pyplot as plt
@@ -24,27 +25,124 @@ def find_stack(scan: dict):
     return stack_key
 
 
-def rot_qc(rot_key_df: pd.DataFrame):
-    fig, axes = plt.subplots(1, 2, figsize=(10, 5))
-    for rot_key in rot_key_df.sort_values("field").to_dict("records"):
-        if rot_key["registration_method"] == 5:
-            frame_num, reg_z = (V.stack.RegistrationOverTime.Affine & rot_key).fetch(
-                "frame_num", "reg_z", order_by="frame_num"
-            )
-            # plot raw reg_z
-            axes[0].plot(frame_num, reg_z, label=f"field {rot_key['field']}")
-            axes[0].set_xlabel("frame_num")
-            axes[0].set_ylabel("reg_z")
-            axes[0].set_title("Affine registration")
-            # plot median subtracted reg_z
-            axes[1].plot(
-                frame_num, reg_z - np.median(reg_z), label=f"field {rot_key['field']}"
+def rot_fingerprint(rot_fields):
+    """Row count and server-side checksum of the affine reg_z traces of `rot_fields`."""
+    return (
+        dj.U().aggr(
+            V.stack.RegistrationOverTime.Affine & rot_fields,
+            n="count(*)",
+            reg_z_crc="sum(crc32(reg_z))",
+        )
+    ).fetch1()
+
+
+ROT_ATTRS = (
+    "animal_id",
+    "stack_session",
+    "stack_idx",
+    "volume_id",
+    "stack_channel",
+    "scan_session",
+    "scan_idx",
+    "scan_channel",
+    "registration_method",
+)
+
+
+def load_rot_qc(rot_key_df: pd.DataFrame, chunk_size=500):
+    """
+    Affine reg_z traces of the fields in `rot_key_df`, which may span any
+    number of scans, fetched `chunk_size` fields per query. Returns a dict
+    mapping the tuple of `ROT_ATTRS` of each scan to its `fetch_rot_qc` data.
+    """
+    if (rot_key_df["registration_method"] != 5).any():
+        raise NotImplementedError("Only registration_method 5 is implemented")
+    restrictions = (
+        rot_key_df[[*ROT_ATTRS, "field"]].drop_duplicates().to_dict("records")
+    )
+    traces = []
+    for i in range(0, len(restrictions), chunk_size):
+        rel = V.stack.RegistrationOverTime.Affine & restrictions[i : i + chunk_size]
+        traces.append(
+            pd.DataFrame(
+                dict(
+                    zip(
+                        [*ROT_ATTRS, "field", "frame_num", "reg_z"],
+                        rel.fetch(*ROT_ATTRS, "field", "frame_num", "reg_z"),
+                    )
+                )
             )
-            axes[1].set_xlabel("frame_num")
-            axes[1].set_ylabel("reg_z - median(reg_z)")
-            axes[1].set_title("Affine registration")
-        else:
-            raise NotImplementedError("Only registration_method 5 is implemented")
+        )
+    traces = pd.concat(traces, ignore_index=True)
+    # one sort puts every scan, then every field, in frame order
+    traces = traces.sort_values([*ROT_ATTRS, "field", "frame_num"], kind="stable")
+    data = {}
+    for rot_key, index in traces.groupby(list(ROT_ATTRS), sort=False).indices.items():
+        rows = traces.iloc[index]
+        data[rot_key] = dict(
+            name="rot_" + utils.dict2str(dict(zip(ROT_ATTRS, rot_key))),
+            field=rows["field"].to_numpy(),
+            frame_num=rows["frame_num"].to_numpy(),
+            reg_z=rows["reg_z"].to_numpy().astype(float),
+        )
+    return data
+
+
+def fetch_rot_qc(rot_key_df: pd.DataFrame):
+    """
+    Affine reg_z traces of the fields in `rot_key_df`, concatenated in field
+    then frame order, with the field of every frame in `field`.
+    """
+    rot_key = rot_key_df[list(ROT_ATTRS)].drop_duplicates()
+    assert len(rot_key) == 1
+    data = load_rot_qc(rot_key_df)
+    if not data:
+        raise MissingError(f"No Affine registration over time for {rot_key.iloc[0].to_dict()}")
+    return next(iter(data.values()))
+
+
+def split_fields(data):
+    """Split the concatenated traces of `data` into (field, frame_num, reg_z) per field."""
+    fields, start = np.unique(data["field"], return_index=True)
+    order = np.argsort(start)
+    fields, start = fields[order], start[order]
+    return zip(
+        fields, np.split(data["frame_num"], start[1:]), np.split(data["reg_z"], start[1:])
+    )
+
+
+def rot_metrics(data, bound=10):
+    """
+    reg_z_range: range of the median-subtracted reg_z over all fields (um)
+    reg_z_out_frac: fraction of frames with a median-subtracted reg_z beyond
+    +-`bound` um
+    """
+    if not len(data["reg_z"]):
+        return dict(reg_z_range=None, reg_z_out_frac=None)
+    drift = np.concatenate([reg_z - np.median(reg_z) for _, _, reg_z in split_fields(data)])
+    return dict(
+        reg_z_range=float(np.ptp(drift)),
+        reg_z_out_frac=float((np.abs(drift) > bound).mean()),
+    )
+
+
+def render_rot_qc(data, dpi=None):
+    fig, axes = plt.subplots(1, 2, figsize=(10, 5), dpi=dpi)
+    n_bins = utils.pixel_width(axes[0])
+    for field, frame_num, reg_z in split_fields(data):
+        # plot raw reg_z
+        axes[0].plot(*utils.decimate(reg_z, frame_num, n_bins), label=f"field {field}")
+        axes[0].set_xlabel("frame_num")
+        axes[0].set_ylabel("reg_z")
+        axes[0].set_title("Affine registration")
+        # plot median subtracted reg_z
+        axes[1].plot(
+            *utils.decimate(reg_z - np.median(reg_z), frame_num, n_bins),
+            label=f"field {field}",
+        )
+        axes[1].set_xlabel("frame_num")
+        axes[1].set_ylabel("reg_z - median(reg_z)")
+        axes[1].set_title("Affine registration")
 
     # plot +- 10 um lines for reference
     axes[1].plot([frame_num[0], frame_num[-1]], [-10, -10], "k--")
@@ -52,19 +150,8 @@ def rot_qc(rot_key_df: pd.DataFrame):
     # set legend outside of axes 1
     axes[1].legend(bbox_to_anchor=(1.05, 1), loc="upper left")
     fig.tight_layout()
-    rot_key = rot_key_df[
-        [
-            "animal_id",
-            "stack_session",
-            "stack_idx",
-            "volume_id",
-            "stack_channel",
-            "scan_session",
-            "scan_idx",
-            "scan_channel",
-            "registration_method",
-        ]
-    ].drop_duplicates()
-    assert len(rot_key) == 1
-    rot_key = rot_key.iloc[0].to_dict()
-    return "rot_" + utils.dict2str(rot_key), fig
+    return data["name"], fig
+
+
+def rot_qc(rot_key_df: pd.DataFrame, dpi=None):
+    return render_rot_qc(fetch_rot_qc(rot_key_df), dpi=dpi)
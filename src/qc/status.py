@@ -0,0 +1,305 @@
+import datajoint as dj
+import pandas as pd
+from . import virtual as V
+from .errors import MissingError
+
+SCAN_ATTRS = ("animal_id", "session", "scan_idx")
+STACK_ATTRS = ("animal_id", "session", "stack_idx")
+REG_SCAN_ATTRS = ("animal_id", "scan_session", "scan_idx")
+# tables of `Scan.table_ls`, in pipeline order
+PIPE_TABLES = (
+    "ScanInfo",
+    "Quality",
+    "RasterCorrection",
+    "MotionCorrection",
+    "SummaryImages",
+    "Segmentation",
+    "Fluorescence",
+    "MaskClassification",
+    "ScanSet",
+    "Activity",
+    "ScanDone",
+)
+SCAN_TABLES = (("pupil", "FittedPupil"), ("treadmill", "Treadmill"))
+STACK_TABLES = (("stack", "CorrectedStack"), ("stack", "PreprocessedStack"))
+
+
+def scan_id(key):
+    return tuple(key[k] for k in SCAN_ATTRS)
+
+
+def count_by(query, attrs):
+    """Count the rows of `query` grouped by `attrs` in a single aggregated query."""
+    rows = dj.U(*attrs).aggr(query, n="count(*)").fetch(*attrs, "n")
+    return {tuple(r[:-1]): int(r[-1]) for r in zip(*rows)}
+
+
+def group_by_pipe(keys):
+    """
+    Returns (grouped, missing): `grouped` maps each pipe name ("meso"/"reso")
+    to the keys of the scans it processed, `missing` lists the keys of the
+    scans found in neither ScanSet nor ScanInfo.
+    """
+    found = pd.DataFrame(
+        (dj.U(*SCAN_ATTRS, "pipe") & (V.fuse.ScanSet & keys)).fetch(as_dict=True),
+        columns=[*SCAN_ATTRS, "pipe"],
+    )
+    # scans with more than one pipe in ScanSet fall back to ScanInfo, like get_pipe
+    found = found.drop_duplicates(list(SCAN_ATTRS), keep=False)
+    pipes = {scan_id(r): r["pipe"] for r in found.to_dict("records")}
+    missing = [k for k in keys if scan_id(k) not in pipes]
+    for pipe in ("meso", "reso"):
+        if not missing:
+            break
+        info = getattr(V, pipe).ScanInfo & missing
+        pipes.update({k: pipe for k in zip(*info.fetch(*SCAN_ATTRS))})
+        missing = [k for k in missing if scan_id(k) not in pipes]
+    grouped = {}
+    for key in keys:
+        if scan_id(key) in pipes:
+            grouped.setdefault(pipes[scan_id(key)], []).append(key)
+    return grouped, missing
+
+
+class BatchStatus:
+    """
+    Set-based version of the per-scan status queries in `Scan`.
+
+    Every query restricts the pipeline tables with the whole key list and is
+    grouped per scan on the server, so the number of round-trips depends on the
+    number of pipes rather than the number of scans. Scans not found in any
+    pipe count as empty and are invalid in `stack_reg_task`.
+    """
+
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self.pipes, self.missing = group_by_pipe(self.keys)
+        self._nfields = None
+        self._stacks = None
+        self._reg_task = None
+
+    @property
+    def nfields(self):
+        if self._nfields is None:
+            self._nfields = {}
+            for pipe, keys in self.pipes.items():
+                self._nfields.update(
+                    count_by(getattr(V, pipe).ScanInfo.Field & keys, SCAN_ATTRS)
+                )
+        return self._nfields
+
+    def _frame(self, done):
+        return pd.DataFrame.from_records(
+            [{**k, "done": done[scan_id(k)]} for k in self.keys]
+        )
+
+    @property
+    def scan_done(self):
+        done = {scan_id(k): False for k in self.missing}
+        for pipe, keys in self.pipes.items():
+            n = count_by(getattr(V, pipe).ScanDone & keys, SCAN_ATTRS)
+            done.update({scan_id(k): bool(n.get(scan_id(k), 0)) for k in keys})
+        return self._frame(done)
+
+    @property
+    def stacks(self):
+        """Map each (animal_id, session) of the batch to the keys of its stacks."""
+        if self._stacks is None:
+            self._stacks = {}
+            for stack_key in (V.experiment.Stack & self.keys).fetch("KEY"):
+                self._stacks.setdefault(
+                    (stack_key["animal_id"], stack_key["session"]), []
+                ).append(stack_key)
+        return self._stacks
+
+    @property
+    def stack_reg_task(self):
+        """
+        Returns a tuple of (tasks, errors): `tasks` maps each pipe to the
+        registration task query of its valid scans and `errors` maps the id of
+        every invalid scan to the exception `Scan.stack_reg_task` would raise.
+        """
+        if self._reg_task is not None:
+            return self._reg_task
+        tasks = {}
+        errors = {scan_id(k): ValueError(f"Scan not found: {k}") for k in self.missing}
+        stacks = self.stacks
+        all_stacks = [s for ls in stacks.values() for s in ls]
+        stack_channels = count_by(V.stack.CorrectionChannel & all_stacks, STACK_ATTRS)
+        corrected = count_by(V.stack.CorrectedStack & all_stacks, STACK_ATTRS)
+        for pipe_name, keys in self.pipes.items():
+            pipe = getattr(V, pipe_name)
+            channels = count_by(pipe.CorrectionChannel & keys, SCAN_ATTRS)
+            summary = count_by(pipe.SummaryImages & keys, SCAN_ATTRS)
+            valid, stack_keys = [], []
+            for key in keys:
+                sid, nfields = scan_id(key), self.nfields.get(scan_id(key), 0)
+                session_stacks = stacks.get((key["animal_id"], key["session"]), [])
+                stack_key = session_stacks[0] if len(session_stacks) == 1 else {}
+                sk = tuple(stack_key.get(k) for k in STACK_ATTRS)
+                if channels.get(sid, 0) != nfields:
+                    errors[sid] = AssertionError(
+                        f"CorrectionChannel is not inserted for scan: {key}"
+                    )
+                elif not session_stacks:
+                    errors[sid] = MissingError(
+                        f"Did not find any stack in the same session for {key}."
+                    )
+                elif not stack_key:
+                    errors[sid] = ValueError(f"Found more than one stack for {key}.")
+                elif summary.get(sid, 0) != nfields:
+                    errors[sid] = AssertionError(f"SummaryImages missing for {key}")
+                elif stack_channels.get(sk, 0) != 1:
+                    errors[sid] = AssertionError(
+                        f"CorrectionChannel is not inserted for stack: {stack_key}"
+                    )
+                elif corrected.get(sk, 0) == 0:
+                    errors[sid] = AssertionError(f"CorrectedStack missing for {stack_key}")
+                else:
+                    valid.append(key)
+                    stack_keys.append(stack_key)
+            if not valid:
+                continue
+            # same composition as Scan.stack_reg_task, with the stack paired to
+            # the scan of the same session
+            corrected_stack = (
+                V.stack.CorrectedStack * V.stack.CorrectionChannel & stack_keys
+            ).proj(stack_session="session", stack_channel="channel")
+            scan_fields = (pipe.ScanInfo * pipe.CorrectionChannel & valid).proj(
+                scan_session="session", scan_channel="channel"
+            )
+            reg_task = (
+                corrected_stack * scan_fields * V.shared.RegistrationMethod & valid
+            ) & "stack_session = scan_session"
+            n = count_by(reg_task, REG_SCAN_ATTRS)
+            for key in valid:
+                if n.get(scan_id(key), 0) != self.nfields.get(scan_id(key), 0):
+                    errors[scan_id(key)] = AssertionError(
+                        f"Number of fields do not match for {key}"
+                    )
+            tasks[pipe_name] = reg_task
+        self._reg_task = tasks, errors
+        return self._reg_task
+
+    def raise_invalid(self):
+        """Raise the `Scan.stack_reg_task` error of the first invalid scan."""
+        _, errors = self.stack_reg_task
+        for key in self.keys:
+            if scan_id(key) in errors:
+                raise errors[scan_id(key)]
+
+    def _task_done(self, task_table, done_table, skip_invalid=False):
+        # invalid scans raise, or are left out of the frame with `skip_invalid`
+        if not skip_invalid:
+            self.raise_invalid()
+        tasks, errors = self.stack_reg_task
+        scheduled, done = {}, {}
+        for reg_task in tasks.values():
+            scheduled.update(count_by(task_table & reg_task, REG_SCAN_ATTRS))
+            done.update(count_by(done_table & reg_task, REG_SCAN_ATTRS))
+        status = {}
+        for key in self.keys:
+            sid, nfields = scan_id(key), self.nfields.get(scan_id(key), 0)
+            if sid in errors:
+                continue
+            if scheduled.get(sid, 0) != nfields:
+                status[sid] = "not scheduled"
+            else:
+                status[sid] = done.get(sid, 0) == nfields
+        return pd.DataFrame.from_records(
+            [{**k, "done": status[scan_id(k)]} for k in self.keys if scan_id(k) in status],
+            columns=[*self.keys[0], "done"] if self.keys else ["done"],
+        )
+
+    @property
+    def stack_jobs_targets(self):
+        """
+        Returns (target_keys, owner_keys) pairing the stack and registration
+        task keys of every scan with the scan key, as in `Scan.stack_jobs_df`.
+        """
+        self.raise_invalid()
+        tasks, _ = self.stack_reg_task
+        task_keys = {}
+        for reg_task in tasks.values():
+            for task_key in reg_task.fetch("KEY"):
+                task_keys.setdefault(
+                    tuple(task_key[k] for k in REG_SCAN_ATTRS), []
+                ).append(task_key)
+        targets, owners = [], []
+        for key in self.keys:
+            scan_targets = [
+                self.stacks[(key["animal_id"], key["session"])][0],
+                *task_keys.get(scan_id(key), []),
+            ]
+            targets += scan_targets
+            owners += [key] * len(scan_targets)
+        return targets, owners
+
+    @property
+    def stack_reg_done(self):
+        return self._task_done(V.stack.RegistrationTask, V.stack.Registration)
+
+    @property
+    def stack_rot_done(self):
+        return self._task_done(
+            V.stack.RegistrationOverTimeTask, V.stack.RegistrationOverTime
+        )
+
+    def valid_stack_rot_done(self):
+        """`stack_rot_done` of the valid scans only, without raising for the others."""
+        return self._task_done(
+            V.stack.RegistrationOverTimeTask, V.stack.RegistrationOverTime, skip_invalid=True
+        )
+
+    def progress(self, jobs_df=None):
+        """
+        Scans x tables frame of the rows of every table of `Scan.table_ls`
+        (per field for the per-field pipe tables, per stack of the session for
+        the stack tables), next to the `nfields` expected. Given `jobs_df`,
+        jobs with the scan key fields as columns (see `JobsSnapshot.split`),
+        the reserved and error jobs of every table are counted alongside.
+        Columns are (table, "rows"/"reserved"/"error").
+        """
+        counts, tables = {}, {}
+        for pipe_name, keys in self.pipes.items():
+            pipe = getattr(V, pipe_name)
+            for name in PIPE_TABLES:
+                table = getattr(pipe, name)
+                counts.setdefault(name, {}).update(count_by(table & keys, SCAN_ATTRS))
+                tables.setdefault(name, set()).add((table.database, table.table_name))
+        for schema_name, name in SCAN_TABLES:
+            table = getattr(getattr(V, schema_name), name)
+            counts[name] = count_by(table & self.keys, SCAN_ATTRS)
+            tables[name] = {(table.database, table.table_name)}
+        for schema_name, name in STACK_TABLES:
+            table = getattr(getattr(V, schema_name), name)
+            per_session = count_by(table & self.keys, ("animal_id", "session"))
+            counts[name] = {
+                scan_id(k): per_session.get((k["animal_id"], k["session"]), 0)
+                for k in self.keys
+            }
+            tables[name] = {(table.database, table.table_name)}
+
+        ids = [scan_id(k) for k in self.keys]
+        index = pd.MultiIndex.from_tuples(ids, names=SCAN_ATTRS)
+        progress = {("nfields", ""): [self.nfields.get(sid, 0) for sid in ids]}
+        jobs = {}
+        if jobs_df is not None and len(jobs_df):
+            jobs_df = jobs_df.assign(
+                database=jobs_df["schema"].map(lambda m: m.schema.database)
+            )
+            jobs = (
+                jobs_df.groupby([*SCAN_ATTRS, "database", "table_name", "status"])
+                .size()
+                .to_dict()
+            )
+        for name, count in counts.items():
+            progress[(name, "rows")] = [count.get(sid, 0) for sid in ids]
+            if jobs_df is None:
+                continue
+            for status in ("reserved", "error"):
+                progress[(name, status)] = [
+                    sum(jobs.get((*sid, *t, status), 0) for t in tables[name])
+                    for sid in ids
+                ]
+        return pd.DataFrame(progress, index=index)
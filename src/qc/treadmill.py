@@ -1,22 +1,82 @@
 # %%
+import datajoint as dj
+import numpy as np
 from matplotlib import pyplot as plt
 from . import virtual as V, utils
+from .errors import MissingError
+
+
+def treadmill_fingerprint(key):
+    """Row count and server-side checksums of the treadmill traces of `key`."""
+    return (
+        dj.U().aggr(
+            V.treadmill.Treadmill & key,
+            n="count(*)",
+            raw_crc="sum(crc32(treadmill_raw))",
+            time_crc="sum(crc32(treadmill_time))",
+            vel_crc="sum(crc32(treadmill_vel))",
+        )
+    ).fetch1()
+
+
+def treadmill_metrics(data, gap_factor=2, jump_threshold=50):
+    """
+    treadmill_dropout_frac: fraction of samples with a NaN velocity or that come
+    more than `gap_factor` median sampling intervals after the previous one
+    treadmill_jump_count: number of sample-to-sample velocity changes larger
+    than `jump_threshold` cm/sec
+    """
+    time = np.ravel(data["treadmill_time"]).astype(float)
+    vel = np.ravel(data["treadmill_vel"]).astype(float)
+    if not len(vel):
+        return dict(treadmill_dropout_frac=None, treadmill_jump_count=None)
+    dt = np.diff(time)
+    gaps = np.r_[False, dt > gap_factor * np.nanmedian(dt)] if len(dt) else False
+    return dict(
+        treadmill_dropout_frac=float((np.isnan(vel) | gaps).mean()),
+        treadmill_jump_count=int((np.abs(np.diff(vel)) > jump_threshold).sum()),
+    )
 
 
 # %%
-def treadmill_qc(key):
-    treadmill_key, treadmill_raw, treadmill_time, treadmill_vel = (
-        V.treadmill.Treadmill() & key
-    ).fetch1("KEY", "treadmill_raw", "treadmill_time", "treadmill_vel")
-    fig, axes = plt.subplots(2, 1, figsize=[10, 5])
-    axes[0].plot(treadmill_time, treadmill_raw, color="k")
+def fetch_treadmill_qc(key):
+    rows = (V.treadmill.Treadmill() & key).fetch(
+        "KEY", "treadmill_raw", "treadmill_time", "treadmill_vel"
+    )
+    if not len(rows[0]):
+        raise MissingError(f"No Treadmill for {key}")
+    assert len(rows[0]) == 1
+    treadmill_key, treadmill_raw, treadmill_time, treadmill_vel = (r[0] for r in rows)
+    return dict(
+        name="treadmill_" + utils.dict2str(treadmill_key),
+        title=f'{key["animal_id"]}-{key["session"]}-{key["scan_idx"]}',
+        treadmill_raw=treadmill_raw,
+        treadmill_time=treadmill_time,
+        treadmill_vel=treadmill_vel,
+    )
+
+
+def render_treadmill_qc(data, dpi=None):
+    fig, axes = plt.subplots(2, 1, figsize=[10, 5], dpi=dpi)
+    # decimated to the axes width: hour-long traces have far more samples than pixels
+    axes[0].plot(
+        *utils.decimate(data["treadmill_raw"], data["treadmill_time"], utils.pixel_width(axes[0])),
+        color="k",
+    )
     axes[0].set_ylabel("Treadmill Raw (cycles)")
-    axes[1].plot(treadmill_time, treadmill_vel, color="k")
+    axes[1].plot(
+        *utils.decimate(data["treadmill_vel"], data["treadmill_time"], utils.pixel_width(axes[1])),
+        color="k",
+    )
     axes[1].set_ylabel("Treadmill Velocity (cm/sec)")
     axes[1].set_xlabel("Time (s)")
-    plt.suptitle(f'{key["animal_id"]}-{key["session"]}-{key["scan_idx"]}')
+    plt.suptitle(data["title"])
     plt.tight_layout()
-    return "treadmill_" + utils.dict2str(treadmill_key), fig
+    return data["name"], fig
+
+
+def treadmill_qc(key, dpi=None):
+    return render_treadmill_qc(fetch_treadmill_qc(key), dpi=dpi)
 
 
 # %%
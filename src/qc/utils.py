@@ -1,10 +1,42 @@
 import datajoint as dj
+import os
 import platform
 import numpy as np
 from pathlib import Path
+from matplotlib.image import AxesImage
 from . import virtual as V
 
 
+default_output_root = "/mnt/lab/users/zhuokun/pipeline_qc"
+default_schema = "zhuokun_pipeline_qc"
+
+
+def get_output_root():
+    """
+    Root folder of the QC figures: $PIPELINE_QC_ROOT, else
+    dj.config["custom"]["pipeline_qc.root"], else `default_output_root`.
+    """
+    custom = dj.config.get("custom") or {}
+    return (
+        os.environ.get("PIPELINE_QC_ROOT")
+        or custom.get("pipeline_qc.root")
+        or default_output_root
+    )
+
+
+def get_schema_name():
+    """
+    Database of `qc.schemas`: $PIPELINE_QC_SCHEMA, else
+    dj.config["custom"]["pipeline_qc.schema"], else `default_schema`.
+    """
+    custom = dj.config.get("custom") or {}
+    return (
+        os.environ.get("PIPELINE_QC_SCHEMA")
+        or custom.get("pipeline_qc.schema")
+        or default_schema
+    )
+
+
 def get_pipe(scan_key):
     try:
         pipe = (dj.U("pipe") & (V.fuse.ScanSet & scan_key)).fetch1("pipe")
@@ -19,26 +51,149 @@ def get_pipe(scan_key):
     return getattr(V, pipe)
 
 
+_path_map = None
+
+
+def normalize_path(path):
+    return path.replace("\\", "/").lower()
+
+
+def get_path_map(refresh=False):
+    """
+    Path prefixes of lab.Paths, loaded once per process (or again with
+    `refresh`). Maps each normalized prefix (forward slashes, lower case, no
+    trailing slash) to the (row, linux path) of the rows it appears in.
+    """
+    global _path_map
+    if _path_map is None or refresh:
+        path_df = V.lab.Paths().fetch(format="frame")
+        _path_map = {}
+        for i, (row, linux) in enumerate(zip(path_df.to_numpy(), path_df.linux)):
+            for cell in row:
+                if isinstance(cell, str) and cell:
+                    matches = _path_map.setdefault(normalize_path(cell).rstrip("/"), [])
+                    if (i, linux) not in matches:
+                        matches.append((i, linux))
+    return _path_map
+
+
+def refresh_path_map():
+    return get_path_map(refresh=True)
+
+
+def translate_path(path, path_map=None):
+    """Translate `path` to linux through the one lab.Paths prefix it starts with."""
+    path_map = get_path_map() if path_map is None else path_map
+    parts = normalize_path(path).split("/")
+    matches = []
+    for i in range(1, len(parts) + 1):
+        prefix = "/".join(parts[:i])
+        matches += [(prefix, linux) for _, linux in path_map.get(prefix, [])]
+    assert len(matches) == 1, f"{len(matches)} lab.Paths entries match {path}"
+    prefix, linux = matches[0]
+    return linux.rstrip("/") + path.replace("\\", "/")[len(prefix) :]
+
+
 def get_linux_folder(key):
     assert "linux" in platform.system().lower()
     scan_path = (V.experiment.Session & key).fetch1("scan_path")
-    path_df = V.lab.Paths().fetch(format="frame")
-    matching = path_df.applymap(lambda x: x in scan_path)
-    assert matching.to_numpy().sum() == 1
-    matching = np.nonzero(matching.to_numpy())
-    matching = np.array(matching).squeeze()
-    scan_path = scan_path.replace("\\", "/").replace(
-        path_df.to_numpy()[matching[0], matching[1]],
-        path_df.iloc[matching[0]].linux,
+    return translate_path(scan_path)
+
+
+def get_linux_folders(keys):
+    """Linux session folders of `keys`, in order, with a single query."""
+    assert "linux" in platform.system().lower()
+    animal_ids, sessions, scan_paths = (V.experiment.Session & keys).fetch(
+        "animal_id", "session", "scan_path"
     )
-    return scan_path
+    folders = {
+        (animal_id, session): translate_path(scan_path)
+        for animal_id, session, scan_path in zip(animal_ids, sessions, scan_paths)
+    }
+    return [folders[(key["animal_id"], key["session"])] for key in keys]
+
+
+def beh_filename(key):
+    return f'{key["animal_id"]}_{key["session"]}_{key["scan_idx"]:0>5}_beh.avi'
 
 
 def get_beh_h5_filepath(key):
-    return Path(
-        get_linux_folder(key)
-        + f'/{key["animal_id"]}_{key["session"]}_{key["scan_idx"]:0>5}_beh.avi'
-    )
+    return Path(get_linux_folder(key) + "/" + beh_filename(key))
+
+
+def get_beh_h5_filepaths(keys):
+    return [
+        Path(folder + "/" + beh_filename(key))
+        for folder, key in zip(get_linux_folders(keys), keys)
+    ]
 
 def dict2str(dic):
-    return '_'.join([f'{k.replace("_", "-")}-{v}' for k,v in dic.items()])
\ No newline at end of file
+    return '_'.join([f'{k.replace("_", "-")}-{v}' for k,v in dic.items()])
+
+def pixel_width(ax):
+    """Width of `ax` in pixels at its figure's dpi."""
+    return max(int(ax.get_window_extent().width), 1)
+
+
+def decimate(y, x=None, n_bins=1000):
+    """
+    Min/max decimation of the trace `y` (sampled at `x`, default the sample
+    index) into `n_bins` bins of consecutive samples, for plotting.
+    The samples at the minimum and maximum of every bin are kept, so spikes
+    survive, as is the first NaN of every bin, so gaps stay visible.
+    Returns (x, y) with at most 3 * `n_bins` samples, in the original order.
+    """
+    y = np.ravel(y).astype(float)
+    x = np.arange(len(y)) if x is None else np.ravel(x)
+    if len(y) <= 3 * n_bins:
+        return x, y
+    size = -(-len(y) // n_bins)
+    padded = np.full(size * -(-len(y) // size), np.nan)
+    padded[: len(y)] = y
+    bins = padded.reshape(-1, size)
+    nans = np.isnan(bins)
+    valid = ~nans.all(1)
+    start = np.arange(len(bins)) * size
+    idx = np.concatenate(
+        [
+            (start + np.where(nans, np.inf, bins).argmin(1))[valid],
+            (start + np.where(nans, -np.inf, bins).argmax(1))[valid],
+            (start + nans.argmax(1))[nans.any(1)],
+        ]
+    )
+    idx = np.unique(idx[idx < len(y)])
+    return x[idx], y[idx]
+
+
+def longest_run(mask):
+    """Length of the longest run of consecutive True values in `mask`."""
+    edges = np.diff(np.r_[0, np.asarray(mask, dtype=np.int8), 0])
+    if not len(edges) or not edges.any():
+        return 0
+    return int((np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)).max())
+
+
+def nbytes(obj):
+    """Memory held by the arrays of a (nested) dict, list or tuple payload."""
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(nbytes(v) for v in obj)
+    return 0
+
+
+def save_figure(fig, filepath, fmt="pdf", dpi=None, rasterize=False):
+    """
+    Save `fig` as `filepath` with the `fmt` suffix (any matplotlib format, e.g.
+    pdf, png or webp) and return the saved path. With `rasterize`, image panels
+    of vector formats are embedded as rasters at `dpi` instead of at the
+    resolution of the source frames.
+    """
+    if rasterize:
+        for image in fig.findobj(AxesImage):
+            image.set_rasterized(True)
+    filepath = Path(f"{filepath}.{fmt}")
+    fig.savefig(filepath, bbox_inches="tight", dpi=dpi or "figure")
+    return filepath
@@ -1,12 +1,76 @@
+import threading
 import datajoint as dj
-treadmill = dj.create_virtual_module("treadmill", "pipeline_treadmill")
-pupil = dj.create_virtual_module("pupil", "pipeline_eye")
-meso = dj.create_virtual_module("meso", "pipeline_meso")
-reso = dj.create_virtual_module("reso", "pipeline_reso")
-fuse = dj.create_virtual_module("fuse", "pipeline_fuse")
-experiment = dj.create_virtual_module("experiment", "pipeline_experiment")
-collection = dj.create_virtual_module("collection", "pipeline_collection")
-stimulus = dj.create_virtual_module("stimulus", "pipeline_stimulus")
-lab = dj.create_virtual_module("lab", "common_lab")
-stack = dj.create_virtual_module("stack", "pipeline_stack")
-shared = dj.create_virtual_module("shared", "pipeline_shared")
\ No newline at end of file
+
+# virtual modules are created on first access, see __getattr__
+schemas = dict(
+    treadmill="pipeline_treadmill",
+    pupil="pipeline_eye",
+    meso="pipeline_meso",
+    reso="pipeline_reso",
+    fuse="pipeline_fuse",
+    experiment="pipeline_experiment",
+    collection="pipeline_collection",
+    stimulus="pipeline_stimulus",
+    lab="common_lab",
+    stack="pipeline_stack",
+    shared="pipeline_shared",
+)
+_lock = threading.Lock()
+_warming = None
+
+
+def _create(names):
+    modules = {}
+    with _lock:
+        for name in names:
+            if name not in globals():
+                modules[name] = dj.create_virtual_module(name, schemas[name])
+    return modules
+
+
+def __getattr__(name):
+    if name not in schemas:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    # the connection is not thread-safe, so wait for warm() rather than share it
+    wait()
+    globals().update(_create([name]))
+    return globals()[name]
+
+
+def __dir__():
+    return [*globals(), *schemas]
+
+
+def warm(names=None, background=True):
+    """
+    Create the virtual modules of `names` (all schemas by default) ahead of use.
+    With `background`, they are created in a thread and published together when
+    it finishes; accessing any virtual module meanwhile waits for the thread.
+    The thread introspects on the shared connection, which is not thread-safe:
+    no other DB work (declaring `qc.schemas`, queries on tables already at
+    hand, `instrument` probes, ...) may run until it finishes, see `wait`.
+    Modules must stay on that connection, for transactions to cover them.
+    """
+    global _warming
+    names = list(schemas) if names is None else names
+    if not background:
+        globals().update(_create(names))
+        return
+
+    def load():
+        global _warming
+        try:
+            globals().update(_create(names))
+        finally:
+            _warming = None
+
+    _warming = threading.Thread(target=load, name="qc-virtual-warm", daemon=True)
+    _warming.start()
+    return _warming
+
+
+def wait():
+    """Wait for a background `warm` to finish, if one is running."""
+    warming = _warming
+    if warming is not None and warming is not threading.current_thread():
+        warming.join()